@@ -0,0 +1,63 @@
+"""Compares two or more benchmarks/run.py result files, the first being the baseline.
+
+    python benchmarks/compare.py benchmarks/results/before.json benchmarks/results/after.json
+"""
+import argparse
+import json
+
+# (label, path into an endpoint's stats, whether lower is better)
+COLUMNS = [
+    ("req/s", ("throughput_rps",), False),
+    ("p50 ms", ("latency_ms", "p50"), True),
+    ("p95 ms", ("latency_ms", "p95"), True),
+    ("p99 ms", ("latency_ms", "p99"), True),
+    ("queries", ("db_queries_per_request",), True),
+]
+
+
+def lookup(stats, path):
+    for key in path:
+        if not isinstance(stats, dict):
+            return None
+        stats = stats.get(key)
+    return stats
+
+
+def cell(value, baseline):
+    if value is None:
+        return "-"
+    if not baseline or baseline == value:
+        return f"{value:g}"
+    return f"{value:g} ({(value - baseline) / baseline:+.0%})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("results", nargs="+", help="Result JSON files; the first is the baseline")
+    args = parser.parse_args()
+    runs = []
+    for path in args.results:
+        with open(path) as f:
+            runs.append(json.load(f))
+    baseline = runs[0]
+    for run, path in zip(runs, args.results):
+        print(f"{path}: commit {run.get('git_commit')}, {run['seed']['systems']} systems, "
+              f"{run['seed']['projects']} projects, {run['websocket']['clients']} clients, "
+              f"{run['config']['concurrency']} concurrent, {run['throughput_rps']} req/s")
+
+    # Each run's endpoints plus the WebSocket delivery latency as one more row.
+    def rows(run):
+        return {**run["endpoints"], "ws_delivery": {"latency_ms": run["websocket"]["latency_ms"]}}
+    names = list(rows(baseline))
+    for run in runs[1:]:
+        names += [name for name in rows(run) if name not in names]
+    for label, path, _ in COLUMNS:
+        print(f"\n{label}")
+        for name in names:
+            base = lookup(rows(baseline).get(name), path)
+            values = [cell(lookup(rows(run).get(name), path), base) for run in runs]
+            print(f"  {name:<14}" + "".join(f"{value:>22}" for value in values))
+
+
+if __name__ == "__main__":
+    main()
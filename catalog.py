@@ -0,0 +1,108 @@
+import json
+from typing import Callable, Dict, Hashable, List, Optional
+
+from sqlalchemy import select
+
+from models import Commodity, StationRequirement, StationRequirementCommodity
+
+# Order of the six dropdown levels, matching the StationRequirement columns.
+HIERARCHY_LEVELS = ("tier", "location", "category", "listed_type", "building_type", "layout")
+
+
+def serialize_station_requirement(req: StationRequirement, commodities: Dict[str, int]) -> dict:
+    return {
+        "id": req.id,
+        "tier": req.tier,
+        "location": req.location,
+        "category": req.category,
+        "listed_type": req.listed_type,
+        "building_type": req.building_type,
+        "layout": req.layout,
+        "commodities": commodities
+    }
+
+
+class StationCatalog:
+    """In-memory copy of the station requirements and their commodity amounts.
+
+    They only change when the CSV is re-imported, so the dropdown and
+    lookup endpoints answer from here instead of querying the database.
+    """
+
+    def __init__(self):
+        # (tree, by_id, by_key, commodity ids by name, response cache) is swapped
+        # as a single reference on reload so readers never observe a half-built catalog.
+        self._snapshot = ({}, {}, {}, {}, {})
+        self.loaded = False
+        self.version = 0
+
+    def load(self, session):
+        tree = {}
+        by_id = {}
+        by_key = {}
+        commodity_ids = {name: commodity_id for commodity_id, name in
+                         session.execute(select(Commodity.id, Commodity.name).order_by(Commodity.id))}
+        names = {commodity_id: name for name, commodity_id in commodity_ids.items()}
+        amounts = {}
+        for row in session.execute(select(StationRequirementCommodity).order_by(
+                StationRequirementCommodity.station_requirement_id, StationRequirementCommodity.commodity_id)).scalars():
+            amounts.setdefault(row.station_requirement_id, {})[names[row.commodity_id]] = row.amount
+        for req in session.query(StationRequirement).order_by(StationRequirement.id).all():
+            entry = serialize_station_requirement(req, amounts.get(req.id, {}))
+            key = tuple(entry[level] for level in HIERARCHY_LEVELS)
+            node = tree
+            for value in key[:-1]:
+                node = node.setdefault(value, {})
+            node[key[-1]] = entry
+            by_id[entry["id"]] = entry
+            by_key[key] = entry
+        self._snapshot = (tree, by_id, by_key, commodity_ids, {})
+        self.loaded = True
+        self.version += 1
+
+    def tree(self) -> dict:
+        return self._snapshot[0]
+
+    def _node(self, path) -> Optional[dict]:
+        node = self._snapshot[0]
+        for value in path:
+            node = node.get(value)
+            if node is None:
+                return None
+        return node
+
+    def has_path(self, *path: str) -> bool:
+        return self._node(path) is not None
+
+    def options(self, *path: str) -> List[str]:
+        """Return the child values below the given (possibly empty) level path."""
+        node = self._node(path)
+        return list(node.keys()) if node is not None else []
+
+    def get(self, requirement_id: int) -> Optional[dict]:
+        return self._snapshot[1].get(requirement_id)
+
+    def find(self, tier: str, location: str, category: str, listed_type: str,
+             building_type: str, layout: str) -> Optional[dict]:
+        return self._snapshot[2].get((tier, location, category, listed_type, building_type, layout))
+
+    def all(self) -> Dict[int, dict]:
+        return self._snapshot[1]
+
+    def commodity_ids(self) -> Dict[str, int]:
+        """Ids of the commodities known when the catalog was loaded, by name."""
+        return self._snapshot[3]
+
+    def cached_json(self, key: Hashable, build: Callable[[], object]) -> bytes:
+        """Serialized response for key, built once per catalog load.
+
+        Only use keys drawn from the catalog itself; the cache lives until the next load.
+        """
+        cache = self._snapshot[4]
+        body = cache.get(key)
+        if body is None:
+            body = cache[key] = json.dumps(build()).encode()
+        return body
+
+
+catalog = StationCatalog()
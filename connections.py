@@ -0,0 +1,184 @@
+import asyncio
+import json
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from fastapi import WebSocket
+
+from metrics import WS_FANOUT_SECONDS, WS_QUEUE_DEPTH
+
+# Bumped whenever the shape of WebSocket messages changes incompatibly.
+WS_PROTOCOL_VERSION = 2
+
+# Close code sent to evicted clients (1013: "Try Again Later"); the UI reconnects and resyncs.
+EVICTION_CLOSE_CODE = 1013
+
+# Upper bound on topics a single socket may subscribe to.
+MAX_SUBSCRIPTIONS = 100
+
+
+def system_topic(system_id: int) -> str:
+    return f"system:{system_id}"
+
+
+def project_topic(project_id: int) -> str:
+    return f"project:{project_id}"
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task = None
+        self.topics: Set[str] = set()
+        # Per-connection sequence number. Clients that see a gap (or a new
+        # "hello") do a single full resync instead of patching state.
+        self.sequence = 0
+
+
+class ConnectionManager:
+    """Fans broadcasts out to WebSocket clients without blocking the caller.
+
+    Every connection gets a bounded outbound queue drained by its own writer
+    task. A client whose queue overflows, or whose send exceeds the timeout,
+    is evicted so it cannot hold back anyone else.
+
+    Clients may subscribe to system and project topics; a topic broadcast only
+    reaches matching subscribers plus clients that have not subscribed to
+    anything (which keep receiving every event).
+    """
+
+    def __init__(self, queue_size: int = 100, send_timeout: float = 5.0):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.subscribers: Dict[str, Set[Connection]] = {}
+        self.unsubscribed: Set[Connection] = set()
+        self.stats = {"events": 0, "queued": 0, "sent": 0, "dropped": 0, "evicted": 0}
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        conn = Connection(websocket, self.queue_size)
+        self._enqueue(conn, json.dumps({"type": "hello", "version": WS_PROTOCOL_VERSION}))
+        conn.writer = asyncio.create_task(self._write_loop(conn))
+        self.connections[websocket] = conn
+        self.unsubscribed.add(conn)
+
+    def disconnect(self, websocket: WebSocket):
+        conn = self.connections.pop(websocket, None)
+        if conn is not None:
+            self._drop_subscriptions(conn)
+            conn.writer.cancel()
+
+    def handle_message(self, websocket: WebSocket, text: str):
+        """Apply a client control message such as {"action": "subscribe", "system_id": 3}."""
+        conn = self.connections.get(websocket)
+        if conn is None:
+            return
+        try:
+            message = json.loads(text)
+            action = message["action"]
+            topics = []
+            if message.get("system_id") is not None:
+                topics.append(system_topic(int(message["system_id"])))
+            if message.get("project_id") is not None:
+                topics.append(project_topic(int(message["project_id"])))
+        except (ValueError, KeyError, TypeError, OverflowError):
+            self._enqueue(conn, json.dumps({"type": "error", "version": WS_PROTOCOL_VERSION, "detail": "Invalid message"}))
+            return
+        if action == "subscribe":
+            self.subscribe(conn, topics)
+        elif action == "unsubscribe":
+            self.unsubscribe(conn, topics)
+        elif action == "unsubscribe_all":
+            self._drop_subscriptions(conn)
+            self.unsubscribed.add(conn)
+        else:
+            self._enqueue(conn, json.dumps({"type": "error", "version": WS_PROTOCOL_VERSION, "detail": "Unknown action"}))
+            return
+        self._enqueue(conn, json.dumps({"type": "subscriptions", "version": WS_PROTOCOL_VERSION, "topics": sorted(conn.topics)}))
+
+    def subscribe(self, conn: Connection, topics: Iterable[str]):
+        for topic in topics:
+            if len(conn.topics) >= MAX_SUBSCRIPTIONS:
+                break
+            conn.topics.add(topic)
+            self.subscribers.setdefault(topic, set()).add(conn)
+        if conn.topics:
+            self.unsubscribed.discard(conn)
+
+    def unsubscribe(self, conn: Connection, topics: Iterable[str]):
+        for topic in topics:
+            conn.topics.discard(topic)
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(conn)
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    def broadcast_event(self, event: dict, topics: Optional[Iterable[str]] = None):
+        """Queue an event for every client, or only for subscribers of the given topics."""
+        started = time.perf_counter()
+        self.stats["events"] += 1
+        if topics is None:
+            recipients = list(self.connections.values())
+        else:
+            recipients = set(self.unsubscribed)
+            for topic in topics:
+                recipients.update(self.subscribers.get(topic, ()))
+        body = json.dumps({**event, "version": WS_PROTOCOL_VERSION})
+        for conn in recipients:
+            self._enqueue(conn, body)
+        WS_FANOUT_SECONDS.observe(time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        depths = [conn.queue.qsize() for conn in self.connections.values()]
+        return {
+            **self.stats,
+            "connections": len(depths),
+            "topics": len(self.subscribers),
+            "queue_depth_max": max(depths, default=0),
+            "queue_depth_total": sum(depths)
+        }
+
+    def _enqueue(self, conn: Connection, body: str):
+        # The event body is serialized once; only the per-connection sequence is spliced in.
+        try:
+            conn.queue.put_nowait('{"seq": %d, %s' % (conn.sequence, body[1:]))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            self._evict(conn)
+            return
+        conn.sequence += 1
+        self.stats["queued"] += 1
+        WS_QUEUE_DEPTH.observe(conn.queue.qsize())
+
+    def _drop_subscriptions(self, conn: Connection):
+        self.unsubscribe(conn, list(conn.topics))
+        self.unsubscribed.discard(conn)
+
+    def _evict(self, conn: Connection):
+        if self.connections.pop(conn.websocket, None) is None:
+            return
+        self._drop_subscriptions(conn)
+        self.stats["evicted"] += 1
+        self.stats["dropped"] += conn.queue.qsize()
+        if conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        asyncio.create_task(self._close(conn.websocket))
+
+    async def _write_loop(self, conn: Connection):
+        while True:
+            message = await conn.queue.get()
+            try:
+                await asyncio.wait_for(conn.websocket.send_text(message), self.send_timeout)
+            except Exception:
+                self._evict(conn)
+                return
+            self.stats["sent"] += 1
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=EVICTION_CLOSE_CODE), self.send_timeout)
+        except Exception:
+            pass
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from metrics import TimedAsyncQueuePool, TimedQueuePool, instrument_engine
+from models import Base, COMPLETION_SQL
+
+log = logging.getLogger("colonytool.database")
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://elite:dangerous@db:5432/colonisation")
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# Connection pool settings, shared by the sync and async engines.
+POOL_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_pre_ping": _env_flag("DB_POOL_PRE_PING", "true"),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+}
+
+# The sync engine is only used for schema setup and the pandas CSV import,
+# which run outside the event loop.
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **POOL_OPTIONS)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(make_url(DATABASE_URL).set(drivername="postgresql+asyncpg"),
+                                   poolclass=TimedAsyncQueuePool, **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Queries are counted and timed against the HTTP request that issued them.
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+
+
+# Idempotent DDL for databases created before an index or column existed;
+# create_all() only creates missing tables.
+SCHEMA_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_projects_system_id ON projects (system_id)",
+    "ALTER TABLE projects ADD COLUMN IF NOT EXISTS total_required INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE projects ADD COLUMN IF NOT EXISTS total_remaining INTEGER NOT NULL DEFAULT 0",
+    f"ALTER TABLE projects ADD COLUMN IF NOT EXISTS completion INTEGER GENERATED ALWAYS AS ({COMPLETION_SQL}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_projects_system_completion ON projects (system_id, completion, id)",
+    "ALTER TABLE projects ADD COLUMN IF NOT EXISTS market_id BIGINT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS projects_market_id_key ON projects (market_id)",
+    # Commodity amounts moved from name-keyed JSONB columns into the commodities,
+    # station_requirement_commodities and project_commodities tables.
+    """
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'station_requirements'
+                     AND column_name = 'commodities') THEN
+            INSERT INTO commodities (name)
+            SELECT DISTINCT e.key FROM station_requirements AS sr, jsonb_each_text(sr.commodities) AS e
+            WHERE jsonb_typeof(sr.commodities) = 'object'
+              AND NOT EXISTS (SELECT 1 FROM commodities AS c WHERE c.name = e.key)
+            ORDER BY e.key;
+            INSERT INTO station_requirement_commodities (station_requirement_id, commodity_id, amount)
+            SELECT sr.id, c.id, e.value::numeric::integer
+            FROM station_requirements AS sr
+            CROSS JOIN LATERAL jsonb_each_text(sr.commodities) AS e
+            JOIN commodities AS c ON c.name = e.key
+            WHERE jsonb_typeof(sr.commodities) = 'object' AND e.value::numeric::integer <> 0
+            ON CONFLICT DO NOTHING;
+            ALTER TABLE station_requirements DROP COLUMN commodities;
+        END IF;
+    END $$
+    """,
+    """
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'projects'
+                     AND column_name = 'progress') THEN
+            CREATE TEMPORARY TABLE legacy_project_commodities ON COMMIT DROP AS
+            SELECT p.id AS project_id, k.name,
+                   (p.requirements ->> k.name)::numeric::integer AS required,
+                   (p.progress ->> k.name)::numeric::integer AS remaining
+            FROM projects AS p
+            CROSS JOIN LATERAL (
+                SELECT jsonb_object_keys(p.requirements) WHERE jsonb_typeof(p.requirements) = 'object'
+                UNION
+                SELECT jsonb_object_keys(p.progress) WHERE jsonb_typeof(p.progress) = 'object'
+            ) AS k(name);
+            INSERT INTO commodities (name)
+            SELECT DISTINCT l.name FROM legacy_project_commodities AS l
+            WHERE NOT EXISTS (SELECT 1 FROM commodities AS c WHERE c.name = l.name)
+            ORDER BY l.name;
+            INSERT INTO project_commodities (project_id, commodity_id, required, remaining)
+            SELECT l.project_id, c.id, l.required, l.remaining
+            FROM legacy_project_commodities AS l JOIN commodities AS c ON c.name = l.name
+            WHERE l.required IS NOT NULL OR l.remaining IS NOT NULL
+            ON CONFLICT DO NOTHING;
+            ALTER TABLE projects DROP COLUMN requirements, DROP COLUMN progress;
+        END IF;
+    END $$
+    """,
+]
+
+
+# Transaction-level advisory lock keys, so that only one worker at a time
+# creates the schema or imports the station requirements CSV.
+SCHEMA_LOCK_KEY = 7243001
+CSV_IMPORT_LOCK_KEY = 7243002
+
+
+def upgrade_schema(connection):
+    for statement in SCHEMA_UPGRADES:
+        connection.execute(text(statement))
+
+
+async def wait_for_database(initial_delay: float = 0.5, max_delay: float = 10.0):
+    """Wait until the database accepts connections, backing off exponentially."""
+    delay = initial_delay
+    attempt = 1
+    while True:
+        try:
+            async with async_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+            log.info("Database is up and ready")
+            return
+        except Exception as e:
+            log.warning("Database not ready, retrying", extra={"attempt": attempt, "retry_in": delay, "error": str(e)})
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            attempt += 1
+
+
+async def prepare_schema():
+    """Create missing tables and apply SCHEMA_UPGRADES."""
+    async with async_engine.begin() as connection:
+        await connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(upgrade_schema)
+
+
+async def get_session():
+    """Per-request session dependency; the session is always closed (and rolled back if uncommitted)."""
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -4,6 +4,18 @@ CREATE TABLE IF NOT EXISTS systems (
     name VARCHAR(255) UNIQUE NOT NULL
 );
 
+-- Create app_state table for application bookkeeping (e.g. the last imported CSV hash).
+CREATE TABLE IF NOT EXISTS app_state (
+    key VARCHAR(100) PRIMARY KEY,
+    value VARCHAR(255) NOT NULL
+);
+
+-- Create commodities table; amounts elsewhere refer to commodities by id.
+CREATE TABLE IF NOT EXISTS commodities (
+    id SMALLSERIAL PRIMARY KEY,
+    name VARCHAR(100) UNIQUE NOT NULL
+);
+
 -- Create station_requirements table.
 CREATE TABLE IF NOT EXISTS station_requirements (
     id SERIAL PRIMARY KEY,
@@ -13,7 +25,6 @@ CREATE TABLE IF NOT EXISTS station_requirements (
     listed_type VARCHAR(100) NOT NULL,
     building_type VARCHAR(100) NOT NULL,
     layout VARCHAR(100) NOT NULL,
-    commodities JSONB,
     CONSTRAINT uix_station_req UNIQUE (tier, location, category, listed_type, building_type, layout)
 );
 
@@ -23,6 +34,41 @@ CREATE TABLE IF NOT EXISTS projects (
     name VARCHAR(255) NOT NULL,
     system_id INTEGER NOT NULL REFERENCES systems(id),
     station_requirement_id INTEGER REFERENCES station_requirements(id),
-    requirements JSONB,
-    progress JSONB
+    market_id BIGINT UNIQUE,
+    total_required INTEGER NOT NULL DEFAULT 0,
+    total_remaining INTEGER NOT NULL DEFAULT 0,
+    completion INTEGER GENERATED ALWAYS AS (
+        CASE WHEN total_required > 0
+             THEN round((total_required - total_remaining) * 100.0 / total_required)::integer ELSE 0 END
+    ) STORED
+);
+
+-- Create station_requirement_commodities table (non-zero amounts only).
+CREATE TABLE IF NOT EXISTS station_requirement_commodities (
+    station_requirement_id INTEGER NOT NULL REFERENCES station_requirements(id) ON DELETE CASCADE,
+    commodity_id SMALLINT NOT NULL REFERENCES commodities(id),
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (station_requirement_id, commodity_id)
 );
+
+-- Create project_commodities table with each project's required and remaining amounts.
+CREATE TABLE IF NOT EXISTS project_commodities (
+    project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    commodity_id SMALLINT NOT NULL REFERENCES commodities(id),
+    required INTEGER,
+    remaining INTEGER,
+    PRIMARY KEY (project_id, commodity_id)
+);
+
+-- Create journal_events table: journal events already applied, for de-duplication.
+CREATE TABLE IF NOT EXISTS journal_events (
+    market_id BIGINT NOT NULL,
+    event_key VARCHAR(64) NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    PRIMARY KEY (market_id, event_key)
+);
+
+CREATE INDEX IF NOT EXISTS ix_projects_system_id ON projects (system_id);
+CREATE INDEX IF NOT EXISTS ix_projects_system_completion ON projects (system_id, completion, id);
+CREATE INDEX IF NOT EXISTS ix_project_commodities_commodity ON project_commodities (commodity_id, remaining);
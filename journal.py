@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from catalog import catalog
+from database import AsyncSessionLocal
+from models import Project, JournalEvent
+from progress import write_progress, build_progress_changes, progress_topics, LOCK_PROJECTS_SQL
+
+log = logging.getLogger("colonytool.journal")
+
+DEPOT_EVENT = "ColonisationConstructionDepot"
+CONTRIBUTION_EVENT = "ColonisationContribution"
+EVENT_KINDS = {DEPOT_EVENT: "depot", CONTRIBUTION_EVENT: "contribution"}
+
+LATEST_DEPOTS_SQL = text("""
+    SELECT market_id, max(timestamp) FROM journal_events
+    WHERE kind = 'depot' AND market_id = ANY(:market_ids)
+    GROUP BY market_id
+""")
+# Everything up to a market's latest depot snapshot is included in it.
+PRUNE_EVENTS_SQL = text("""
+    DELETE FROM journal_events AS e
+    USING (SELECT market_id, max(timestamp) AS latest FROM journal_events
+           WHERE kind = 'depot' AND market_id = ANY(:market_ids) GROUP BY market_id) AS d
+    WHERE e.market_id = d.market_id
+      AND (e.timestamp < d.latest OR (e.kind = 'contribution' AND e.timestamp = d.latest))
+""")
+
+# Internal journal resource names whose words differ from our commodity names.
+RESOURCE_ALIASES = {
+    "terrainenrichmentsystems": "Land Enrichment Systems",
+    "agriculturalmedicines": "Agri-Medicines",
+}
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def _timestamp(value: str) -> datetime:
+    # "2025-04-09T18:43:21Z" -> naive UTC
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+
+def _event_key(event: dict) -> str:
+    return hashlib.sha256(json.dumps(event, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def _bounded(value, limit: int) -> int:
+    # Out of range values would fail the batched write for every queued event.
+    number = int(value)
+    if not 0 <= number < limit:
+        raise ValueError(f"{value!r} is out of range")
+    return number
+
+
+def _resources(event: dict, key: str) -> List[dict]:
+    resources = event[key]
+    if not isinstance(resources, list) or not all(
+            isinstance(resource, dict) and all(isinstance(resource.get(field) or "", str)
+                                               for field in ("Name", "Name_Localised"))
+            for resource in resources):
+        raise TypeError(f"{key} must be a list of resources with string names")
+    return resources
+
+
+def _internal_name(name: str) -> str:
+    # "$CMMComposite_name;" -> "cmmcomposite"
+    name = name.strip()
+    if name.startswith("$"):
+        name = name[1:]
+    if name.lower().endswith("_name;"):
+        name = name[:-len("_name;")]
+    return _normalize(name)
+
+
+class CommodityResolver:
+    """Maps journal resource names onto the commodity keys used in the catalog."""
+
+    def __init__(self):
+        self._version = None
+        self._names: Dict[str, str] = {}
+
+    def resolve(self, resource: dict) -> Optional[str]:
+        if self._version != catalog.version:
+            names = {}
+            for req in catalog.all().values():
+                for commodity in req["commodities"]:
+                    names[_normalize(commodity)] = commodity
+            for alias, commodity in RESOURCE_ALIASES.items():
+                names.setdefault(alias, commodity)
+            self._names, self._version = names, catalog.version
+        for candidate in (_internal_name(resource.get("Name") or ""), _normalize(resource.get("Name_Localised") or "")):
+            if candidate and candidate in self._names:
+                return self._names[candidate]
+        return None
+
+
+class MarketEvents:
+    """Pending events of one depot: its latest snapshot and the contributions by event key."""
+
+    def __init__(self):
+        # (timestamp, event key, {commodity: remaining}) of the latest ColonisationConstructionDepot
+        self.depot: Optional[Tuple[datetime, str, Dict[str, int]]] = None
+        # event key -> (timestamp, {commodity: delivered})
+        self.contributions: Dict[str, Tuple[datetime, Dict[str, int]]] = {}
+
+    def add_depot(self, timestamp: datetime, key: str, remaining: Dict[str, int]):
+        # On equal timestamps the later arrival wins, as it does in the journal.
+        if self.depot is None or timestamp >= self.depot[0]:
+            self.depot = (timestamp, key, remaining)
+
+    def merge(self, newer: "MarketEvents"):
+        if newer.depot is not None:
+            self.add_depot(*newer.depot)
+        self.contributions.update(newer.contributions)
+
+    def rows(self, market_id: int) -> List[dict]:
+        rows = [{"market_id": market_id, "event_key": key, "kind": "contribution", "timestamp": timestamp}
+                for key, (timestamp, _) in self.contributions.items()]
+        if self.depot is not None:
+            rows.append({"market_id": market_id, "event_key": self.depot[1], "kind": "depot", "timestamp": self.depot[0]})
+        return rows
+
+
+class JournalIngestor:
+    """Coalesces colonisation journal events into one batched write per flush window.
+
+    ColonisationConstructionDepot events carry absolute amounts: the latest one
+    per depot replaces the stored remaining amounts. ColonisationContribution
+    events carry delivered amounts, which are summed and subtracted from that
+    snapshot (or from the stored progress if there is none). Contributions not
+    newer than the depot's latest snapshot are already included in it and are
+    skipped.
+
+    Applied events are recorded in journal_events, so a journal that is sent
+    twice (a client retrying after a timeout, or a replayed file) changes
+    nothing the second time. Depots are matched to projects through
+    Project.market_id.
+    """
+
+    def __init__(self, pubsub, flush_interval: float = 2.0):
+        self.pubsub = pubsub
+        self.flush_interval = flush_interval
+        self.resolver = CommodityResolver()
+        self.pending: Dict[int, MarketEvents] = {}
+        self.stats = {"events": 0, "ignored": 0, "invalid": 0, "unmatched_resources": 0,
+                      "unmatched_markets": 0, "duplicate_events": 0, "flushes": 0, "projects_updated": 0}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def submit_line(self, line) -> Optional[str]:
+        """Queue one journal line; returns "accepted", "ignored", "invalid" or None for blank lines."""
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            event = json.loads(line)
+            accepted = self.submit(event)
+        except (ValueError, KeyError, TypeError, OverflowError):
+            self.stats["invalid"] += 1
+            return "invalid"
+        return "accepted" if accepted else "ignored"
+
+    def submit(self, event: dict) -> bool:
+        if not isinstance(event, dict):
+            raise TypeError("Journal event must be an object")
+        name = event.get("event")
+        if name not in (DEPOT_EVENT, CONTRIBUTION_EVENT):
+            self.stats["ignored"] += 1
+            return False
+        market_id = _bounded(event["MarketID"], 2 ** 63)
+        if not isinstance(event["timestamp"], str):
+            raise TypeError("timestamp must be a string")
+        timestamp = _timestamp(event["timestamp"])
+        resources = _resources(event, "ResourcesRequired" if name == DEPOT_EVENT else "Contributions")
+        amounts = {}
+        for resource in resources:
+            commodity = self.resolver.resolve(resource)
+            if commodity is None:
+                self.stats["unmatched_resources"] += 1
+                continue
+            if name == DEPOT_EVENT:
+                amounts[commodity] = max(_bounded(resource["RequiredAmount"], 2 ** 31)
+                                         - _bounded(resource["ProvidedAmount"], 2 ** 31), 0)
+            else:
+                amounts[commodity] = amounts.get(commodity, 0) + _bounded(resource["Amount"], 2 ** 31)
+        market = self.pending.setdefault(market_id, MarketEvents())
+        if name == DEPOT_EVENT:
+            market.add_depot(timestamp, _event_key(event), amounts)
+        else:
+            market.contributions[_event_key(event)] = (timestamp, amounts)
+        self.stats["events"] += 1
+        return True
+
+    async def flush(self) -> List[dict]:
+        async with self._flush_lock:
+            pending, self.pending = self.pending, {}
+            if not pending:
+                return []
+            async with AsyncSessionLocal() as session:
+                try:
+                    rows, touched = await self._apply(session, pending)
+                    await session.commit()
+                except Exception as e:
+                    log.warning("Journal flush failed, will retry", extra={"markets": len(pending), "error": str(e)})
+                    self._requeue(pending)
+                    return []
+                if not rows:
+                    return []
+                self.stats["flushes"] += 1
+                self.stats["projects_updated"] += len(rows)
+                # The batch is committed now; re-queueing it would subtract its deliveries again.
+                try:
+                    return await self._broadcast(session, rows, touched)
+                except Exception:
+                    log.exception("Journal progress saved but not broadcast", extra={"projects": len(rows)})
+                    return []
+
+    async def _apply(self, session, pending: Dict[int, MarketEvents]):
+        """Write the pending amounts without committing; returns (rows, touched commodities by project)."""
+        result = await session.execute(
+            select(Project.market_id, Project.id).filter(Project.market_id.in_(list(pending)))
+        )
+        projects = dict(result.all())
+        self.stats["unmatched_markets"] += len(set(pending) - set(projects))
+        if not projects:
+            return {}, {}
+        # Lock the projects first so concurrent flushes of the same depot see each other's events.
+        await session.execute(LOCK_PROJECTS_SQL, {"project_ids": sorted(projects.values())})
+        events = [row for market_id in projects for row in pending[market_id].rows(market_id)]
+        new_keys = set()
+        for i in range(0, len(events), 1000):
+            result = await session.execute(
+                pg_insert(JournalEvent).values(events[i:i + 1000]).on_conflict_do_nothing()
+                .returning(JournalEvent.market_id, JournalEvent.event_key)
+            )
+            new_keys.update(result.all())
+        self.stats["duplicate_events"] += len(events) - len(new_keys)
+        latest = dict((await session.execute(LATEST_DEPOTS_SQL, {"market_ids": list(projects)})).all())
+
+        patches, deltas = {}, {}
+        for market_id, project_id in projects.items():
+            market, snapshot_at = pending[market_id], latest.get(market_id)
+            delivered = {}
+            for key, (timestamp, amounts) in market.contributions.items():
+                if (market_id, key) in new_keys and (snapshot_at is None or timestamp > snapshot_at):
+                    for commodity, amount in amounts.items():
+                        delivered[commodity] = delivered.get(commodity, 0) + amount
+            depot = market.depot
+            if depot is not None and (market_id, depot[1]) in new_keys and depot[0] == snapshot_at:
+                for commodity, remaining in depot[2].items():
+                    patches.setdefault(project_id, {})[commodity] = max(remaining - delivered.pop(commodity, 0), 0)
+            if delivered:
+                deltas[project_id] = delivered
+        await session.execute(PRUNE_EVENTS_SQL, {"market_ids": list(projects)})
+        if not patches and not deltas:
+            return {}, {}
+        rows = await write_progress(session, patches, deltas)
+        touched = {project_id: set(patches.get(project_id, ())) | set(deltas.get(project_id, ())) for project_id in rows}
+        return rows, touched
+
+    async def _broadcast(self, session, rows: Dict[int, dict], touched: Dict[int, set]) -> List[dict]:
+        changes = await build_progress_changes(session, touched, rows)
+        await self.pubsub.publish({"type": "progress_batch", "changes": changes}, topics=progress_topics(changes),
+                                  system_ids={row["system_id"] for row in rows.values()}, project_ids=rows.keys())
+        return changes
+
+    def _requeue(self, failed: Dict[int, MarketEvents]):
+        # Events that arrived during the failed flush are newer and go on top.
+        newer, self.pending = self.pending, failed
+        for market_id, market in newer.items():
+            self.pending.setdefault(market_id, MarketEvents()).merge(market)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
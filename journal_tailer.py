@@ -0,0 +1,118 @@
+"""Tails the Elite Dangerous journal and forwards colonisation events to ColonyTool.
+
+    python journal_tailer.py --url http://localhost:8000
+    python journal_tailer.py --dry-run fixtures/journal/*.log
+
+Only the standard library is used so it can run on the machine playing the game.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+COLONISATION_EVENTS = {"ColonisationConstructionDepot", "ColonisationContribution"}
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser("~"), "Saved Games", "Frontier Developments", "Elite Dangerous")
+
+
+def colonisation_lines(lines):
+    """Yield the raw journal lines that carry colonisation events."""
+    for line in lines:
+        line = line.strip()
+        if not line or "Colonisation" not in line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event.get("event") in COLONISATION_EVENTS:
+            yield line
+
+
+def post_lines(url, lines, flush=False):
+    body = ("\n".join(lines) + "\n").encode("utf-8")
+    endpoint = url.rstrip("/") + "/journal" + ("?flush=true" if flush else "")
+    request = urllib.request.Request(endpoint, data=body, method="POST",
+                                     headers={"Content-Type": "application/x-ndjson"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def send(args, lines, flush=False):
+    if not lines:
+        return
+    if args.dry_run:
+        for line in lines:
+            print(line)
+        return
+    result = post_lines(args.url, lines, flush=flush)
+    print(f"Sent {len(lines)} events: {result}")
+
+
+def latest_journal(journal_dir):
+    paths = glob.glob(os.path.join(journal_dir, "Journal.*.log"))
+    # Journal names embed their start time, so the newest file sorts last.
+    return max(paths, key=os.path.basename) if paths else None
+
+
+def replay(args):
+    lines = []
+    for path in args.files:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines.extend(colonisation_lines(f))
+    send(args, lines, flush=True)
+
+
+def tail(args):
+    path, handle, buffer = None, None, ""
+    print("Watching", args.journal_dir)
+    while True:
+        newest = latest_journal(args.journal_dir)
+        if newest != path and newest is not None:
+            # The game starts a new journal on every launch and after each part
+            # fills up; finish the old one before switching.
+            if handle is not None:
+                buffer += handle.read()
+                handle.close()
+            first = path is None
+            path, handle = newest, open(newest, encoding="utf-8", errors="replace")
+            if first and not args.from_start:
+                handle.seek(0, os.SEEK_END)
+            print("Following", os.path.basename(path))
+        if handle is not None:
+            buffer += handle.read()
+        # Keep a partially written last line for the next pass.
+        complete, _, buffer = buffer.rpartition("\n")
+        lines = list(colonisation_lines(complete.splitlines()))
+        try:
+            send(args, lines)
+        except (urllib.error.URLError, OSError) as e:
+            # Safe even if the server did get the batch: it ignores events it has already applied.
+            print("Could not reach ColonyTool, will retry:", e, file=sys.stderr)
+            buffer = "\n".join(lines) + "\n" + buffer
+        time.sleep(args.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="Journal files to send once instead of tailing (e.g. fixtures)")
+    parser.add_argument("--journal-dir", default=DEFAULT_JOURNAL_DIR, help="Directory containing Journal.*.log files")
+    parser.add_argument("--url", default="http://localhost:8000", help="ColonyTool base URL")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between polls")
+    parser.add_argument("--from-start", action="store_true", help="Send the current journal from the beginning")
+    parser.add_argument("--dry-run", action="store_true", help="Print events instead of sending them")
+    args = parser.parse_args()
+    if args.files:
+        replay(args)
+    else:
+        try:
+            tail(args)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,137 +1,268 @@
 import os
+import io
 import time
-import csv
-import pandas as pd
-import numpy as np
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query
-from fastapi.responses import FileResponse, HTMLResponse
+import asyncio
+import json
+import hashlib
+import logging
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Depends, Request, Response
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import sessionmaker, joinedload
-from sqlalchemy.orm.attributes import flag_modified
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select, delete, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from models import Base, System, Project, StationRequirement
+from models import AppState, System, Project, StationRequirement, Commodity, StationRequirementCommodity, ProjectCommodity
+from catalog import catalog, HIERARCHY_LEVELS
+from connections import ConnectionManager, system_topic
+from versions import versions, conditional
+from pubsub import create_pubsub
+from journal import JournalIngestor
+from planner import HaulPlanner, DEFAULT_CAPACITIES, MAX_CAPACITIES, MIN_CAPACITY
+from transfer import export_ndjson, export_csv, parse_import, import_records
+from database import SessionLocal, engine, async_engine, get_session, wait_for_database, prepare_schema, CSV_IMPORT_LOCK_KEY
+from progress import (compute_totals, apply_progress_patches, build_progress_changes, progress_topics,
+                      compute_system_aggregate, recompute_totals, resolve_commodity_ids, load_project_commodities,
+                      REGISTER_COMMODITIES_SQL)
+from metrics import registry, register_callback, Counter, Gauge, MetricsMiddleware, CSV_IMPORT_SECONDS
+from logs import configure_logging
 
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://elite:dangerous@db:5432/colonisation")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def wait_for_db(engine, retries=10, wait=2):
-    for i in range(retries):
-        try:
-            with engine.connect() as connection:
-                print("Database is up and ready!")
-                return
-        except Exception as e:
-            print(f"Database not ready, retrying in {wait} seconds... ({i+1}/{retries})")
-            time.sleep(wait)
-    raise Exception("Database connection failed after multiple retries")
-
-wait_for_db(engine)
-Base.metadata.create_all(bind=engine)
+configure_logging()
+log = logging.getLogger("colonytool.app")
 
 # ---------------------
 # CSV Update Function (using pandas for cleaning)
 # ---------------------
-def update_station_requirements():
+# Rows per INSERT statement; keeps very large community sheets under the bind parameter limit.
+UPSERT_BATCH_SIZE = 1000
+
+STATION_REQUIREMENTS_CSV = "StationRequirements.csv"
+# The last imported CSV is recorded as "<import version>:<sha256>"; bump the
+# version when parsing changes so existing databases re-import once.
+CSV_IMPORT_VERSION = 1
+CSV_HASH_KEY = "station_requirements_csv"
+
+def parse_station_requirements(source=STATION_REQUIREMENTS_CSV):
+    # pandas is slow to import and only needed here, so it is loaded on first use.
+    import numpy as np
+    import pandas as pd
+    df = pd.read_csv(source, header=0)
+    drop_cols = ['Required Facility In System', 'Construction Points Cost',
+                 'Construction Points Reward', 'Pad', 'Facility Economy',
+                 'Initial Population Increase', 'Max Population Increase',
+                 'System Economy Influence', 'Security', 'Tech Level', 'Wealth',
+                 'Standard of Living', 'Development Level', 'Total amount of Commodities',
+                 '# Trips with 784 cargo space (L)', '# Trips with 400 cargo space (M)']
+    df = df.drop(columns=drop_cols, errors='ignore')
+    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+    numeric_columns = df.select_dtypes(include=['float64']).columns
+    df[numeric_columns] = df[numeric_columns].replace([np.inf, -np.inf], np.nan).fillna(0).astype(int)
+    if df.shape[1] < 7:
+        raise Exception("CSV must have at least 7 columns (6 for hierarchy and at least 1 commodity)")
+    hierarchy_keys = list(df.columns[:6])
+    commodity_keys = list(df.columns[6:])
+    hierarchy = df[hierarchy_keys].apply(lambda col: col.where(col.notna(), "").astype(str).str.strip())
+    commodities = df[commodity_keys].apply(pd.to_numeric, errors='coerce').fillna(0).astype(int)
+    # Skip rows with an empty hierarchy level; later rows win for duplicate keys.
+    keep = (hierarchy != "").all(axis=1) & ~hierarchy.duplicated(keep='last')
+    hierarchy = hierarchy[keep]
+    commodities = commodities[keep]
+    return [
+        {
+            "tier": key[0],
+            "location": key[1],
+            "category": key[2],
+            "listed_type": key[3],
+            "building_type": key[4],
+            "layout": key[5],
+            "commodities": dict(zip(commodity_keys, amounts))
+        }
+        for key, amounts in zip(hierarchy.itertuples(index=False), commodities.to_numpy().tolist())
+    ]
+
+def load_catalog():
     session = SessionLocal()
     try:
-        df = pd.read_csv("StationRequirements.csv", header=0)
-        drop_cols = ['Required Facility In System', 'Construction Points Cost',
-                     'Construction Points Reward', 'Pad', 'Facility Economy',
-                     'Initial Population Increase', 'Max Population Increase',
-                     'System Economy Influence', 'Security', 'Tech Level', 'Wealth',
-                     'Standard of Living', 'Development Level', 'Total amount of Commodities',
-                     '# Trips with 784 cargo space (L)', '# Trips with 400 cargo space (M)']
-        df = df.drop(columns=drop_cols, errors='ignore')
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-        numeric_columns = df.select_dtypes(include=['float64']).columns
-        df[numeric_columns] = df[numeric_columns].replace([np.inf, -np.inf], np.nan).fillna(0).astype(int)
-        if df.shape[1] < 7:
-            raise Exception("CSV must have at least 7 columns (6 for hierarchy and at least 1 commodity)")
-        hierarchy_keys = list(df.columns[:6])
-        commodity_keys = list(df.columns[6:])
-        unique_recs = {}
-        for _, row in df.iterrows():
-            tier = str(row[hierarchy_keys[0]]).strip() if pd.notnull(row[hierarchy_keys[0]]) else ""
-            location = str(row[hierarchy_keys[1]]).strip() if pd.notnull(row[hierarchy_keys[1]]) else ""
-            category = str(row[hierarchy_keys[2]]).strip() if pd.notnull(row[hierarchy_keys[2]]) else ""
-            listed_type = str(row[hierarchy_keys[3]]).strip() if pd.notnull(row[hierarchy_keys[3]]) else ""
-            building_type = str(row[hierarchy_keys[4]]).strip() if pd.notnull(row[hierarchy_keys[4]]) else ""
-            layout = str(row[hierarchy_keys[5]]).strip() if pd.notnull(row[hierarchy_keys[5]]) else ""
-            if not (tier and location and category and listed_type and building_type and layout):
+        catalog.load(session)
+    finally:
+        session.close()
+
+def update_station_requirements(force=True):
+    """Import the CSV and reload the catalog.
+
+    Unless forced, the import is skipped (returning None) when the CSV matches
+    the last imported one. Workers starting together import it only once.
+    """
+    started = time.perf_counter()
+    with open(STATION_REQUIREMENTS_CSV, "rb") as f:
+        content = f.read()
+    content_hash = f"{CSV_IMPORT_VERSION}:{hashlib.sha256(content).hexdigest()}"
+    inserted_ids = set()
+    updated = 0
+    session = SessionLocal()
+    try:
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CSV_IMPORT_LOCK_KEY})
+        last_import = session.get(AppState, CSV_HASH_KEY)
+        if not force and last_import is not None and last_import.value == content_hash:
+            session.rollback()
+            catalog.load(session)
+            CSV_IMPORT_SECONDS.observe(time.perf_counter() - started, "skipped")
+            return None
+        rows = parse_station_requirements(io.BytesIO(content))
+        # Commodity ids follow the CSV column order the first time a commodity is seen.
+        names = list(rows[0]["commodities"]) if rows else []
+        session.execute(REGISTER_COMMODITIES_SQL, {"names": names})
+        commodity_ids = dict(session.execute(select(Commodity.name, Commodity.id)).all())
+        key_columns = [getattr(StationRequirement, column) for column in HIERARCHY_LEVELS]
+        existing = {tuple(row[1:]): row[0] for row in session.execute(select(StationRequirement.id, *key_columns))}
+        new_rows = [{column: row[column] for column in HIERARCHY_LEVELS} for row in rows
+                    if tuple(row[column] for column in HIERARCHY_LEVELS) not in existing]
+        for i in range(0, len(new_rows), UPSERT_BATCH_SIZE):
+            stmt = pg_insert(StationRequirement).values(new_rows[i:i + UPSERT_BATCH_SIZE])
+            stmt = stmt.on_conflict_do_nothing(constraint="uix_station_req").returning(StationRequirement.id, *key_columns)
+            for row in session.execute(stmt):
+                existing[tuple(row[1:])] = row[0]
+                inserted_ids.add(row[0])
+        # Only amounts that differ from the stored ones are written; zeros are not stored.
+        current = {}
+        for row in session.execute(select(StationRequirementCommodity)).scalars():
+            current.setdefault(row.station_requirement_id, {})[row.commodity_id] = row.amount
+        upserts, deletes = [], []
+        for row in rows:
+            requirement_id = existing[tuple(row[column] for column in HIERARCHY_LEVELS)]
+            stored = current.get(requirement_id, {})
+            wanted = {commodity_ids[name]: amount for name, amount in row["commodities"].items() if amount != 0}
+            if stored == wanted:
                 continue
-            commodities = {}
-            for key in commodity_keys:
-                try:
-                    commodities[key] = int(row[key]) if pd.notnull(row[key]) and row[key] != "" else 0
-                except ValueError:
-                    commodities[key] = 0
-            unique_recs[(tier, location, category, listed_type, building_type, layout)] = commodities
-        for key, commodities in unique_recs.items():
-            tier, location, category, listed_type, building_type, layout = key
-            record = session.query(StationRequirement).filter(
-                StationRequirement.tier == tier,
-                StationRequirement.location == location,
-                StationRequirement.category == category,
-                StationRequirement.listed_type == listed_type,
-                StationRequirement.building_type == building_type,
-                StationRequirement.layout == layout
-            ).first()
-            if not record:
-                record = StationRequirement(
-                    tier=tier,
-                    location=location,
-                    category=category,
-                    listed_type=listed_type,
-                    building_type=building_type,
-                    layout=layout,
-                    commodities=commodities
-                )
-                session.add(record)
-            else:
-                record.commodities = commodities
+            if requirement_id not in inserted_ids:
+                updated += 1
+            upserts += [{"station_requirement_id": requirement_id, "commodity_id": commodity_id, "amount": amount}
+                        for commodity_id, amount in wanted.items() if stored.get(commodity_id) != amount]
+            deletes += [(requirement_id, commodity_id) for commodity_id in stored if commodity_id not in wanted]
+        for i in range(0, len(upserts), UPSERT_BATCH_SIZE):
+            stmt = pg_insert(StationRequirementCommodity).values(upserts[i:i + UPSERT_BATCH_SIZE])
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=["station_requirement_id", "commodity_id"], set_={"amount": stmt.excluded.amount}
+            ))
+        for i in range(0, len(deletes), UPSERT_BATCH_SIZE):
+            session.execute(delete(StationRequirementCommodity).where(tuple_(
+                StationRequirementCommodity.station_requirement_id, StationRequirementCommodity.commodity_id
+            ).in_(deletes[i:i + UPSERT_BATCH_SIZE])))
+        # Requirement amounts feed each project's stored totals.
+        recompute_totals(session)
+        session.merge(AppState(key=CSV_HASH_KEY, value=content_hash))
         session.commit()
+        catalog.load(session)
     except Exception as e:
         session.rollback()
+        CSV_IMPORT_SECONDS.observe(time.perf_counter() - started, "failed")
         raise e
     finally:
         session.close()
+    CSV_IMPORT_SECONDS.observe(time.perf_counter() - started, "imported")
+    inserted = len(inserted_ids)
+    return {"inserted": inserted, "updated": updated, "unchanged": len(rows) - inserted - updated}
 
 # ---------------------
 # Lifespan Handler
 # ---------------------
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+# Startup runs in the background so the process answers /healthz straight
+# away; everything else returns 503 until /readyz reports ready.
+startup = {"ready": False, "stage": "starting", "error": None}
+
+async def start_up():
     try:
-        update_station_requirements()
-        print("Station requirements updated from CSV on startup.")
+        startup["stage"] = "waiting for database"
+        await wait_for_database()
+        startup["stage"] = "preparing schema"
+        await prepare_schema()
+        startup["stage"] = "loading station requirements"
+        try:
+            counts = await run_in_threadpool(update_station_requirements, False)
+            if counts is None:
+                log.info("Station requirements CSV unchanged since the last import, skipped")
+            else:
+                log.info("Station requirements updated from CSV on startup", extra=counts)
+        except Exception:
+            log.exception("Error updating station requirements on startup")
+        if not catalog.loaded:
+            await run_in_threadpool(load_catalog)
+        startup["stage"] = "starting background tasks"
+        await pubsub.start()
+        await journal.start()
+        startup.update(ready=True, stage="ready")
     except Exception as e:
-        print("Error updating station requirements on startup:", e)
+        startup.update(stage="failed", error=str(e))
+        log.exception("Startup failed")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(start_up())
     yield
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+    await journal.stop()
+    await pubsub.stop()
+
+# Paths served before startup has finished.
+STARTUP_OPEN_PATHS = ("/healthz", "/readyz", "/metrics", "/")
+
+class StartupGate:
+    """ASGI middleware answering 503 (or closing WebSockets) until startup is complete."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (not startup["ready"] and scope["type"] in ("http", "websocket")
+                and scope["path"] not in STARTUP_OPEN_PATHS and not scope["path"].startswith("/static/")):
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": 1013})
+                return
+            response = JSONResponse({"detail": f"Service starting: {startup['stage']}"}, status_code=503,
+                                    headers={"Retry-After": "2"})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
 
 app = FastAPI(title="Elite Dangerous Colonisation API", lifespan=lifespan)
+app.add_middleware(StartupGate)
+# Outermost, so requests turned away during startup are counted too.
+app.add_middleware(MetricsMiddleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # ---------------------
 # WebSocket Manager for Real-Time Updates
 # ---------------------
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-
-manager = ConnectionManager()
+manager = ConnectionManager(
+    queue_size=int(os.getenv("WS_QUEUE_SIZE", "100")),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT", "5"))
+)
+
+# Change notifications (ETag versions and WebSocket events) go through the pub/sub
+# backend so that, with PUBSUB_BACKEND=postgres, every worker and replica sees them.
+pubsub = create_pubsub(manager, versions)
+
+# Player journal events are coalesced and written once per flush window.
+journal = JournalIngestor(pubsub, flush_interval=float(os.getenv("JOURNAL_FLUSH_INTERVAL", "2")))
+# Haul plans are cached per system version.
+planner = HaulPlanner(versions)
+
+# Gauges and counters read from existing state when /metrics is scraped.
+register_callback(Gauge("colonytool_ws_connections", "Open WebSocket connections."),
+                  lambda: len(manager.connections))
+register_callback(Counter("colonytool_ws_messages_total", "WebSocket fan-out counters by outcome.", ("outcome",)),
+                  lambda: {(outcome,): manager.stats[outcome] for outcome in ("queued", "sent", "dropped", "evicted")})
+register_callback(Counter("colonytool_ws_events_total", "Events broadcast to WebSocket clients."),
+                  lambda: manager.stats["events"])
+register_callback(Gauge("colonytool_db_pool_checked_out", "Database connections currently checked out.", ("engine",)),
+                  lambda: {("sync",): engine.pool.checkedout(), ("async",): async_engine.pool.checkedout()})
 
 # ---------------------
 # Request Models
@@ -143,13 +274,25 @@ class CreateProjectRequest(BaseModel):
     name: str
     system_id: int
     station_requirement_id: Optional[int] = None
+    market_id: Optional[int] = None
     # New field: 'requirements' holds the overridden required amounts.
-    requirements: Optional[dict] = None
+    requirements: Optional[Dict[str, int]] = None
+
+class MarketLinkRequest(BaseModel):
+    market_id: Optional[int] = None
 
 class UpdateProgressRequest(BaseModel):
     commodity: str
     remaining: int
 
+class ProgressChange(BaseModel):
+    project_id: int
+    commodity: str
+    remaining: int
+
+class BatchProgressRequest(BaseModel):
+    updates: List[ProgressChange]
+
 # ---------------------
 # WebSocket Endpoint
 # ---------------------
@@ -158,10 +301,17 @@ async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            await websocket.receive_text()
+            manager.handle_message(websocket, await websocket.receive_text())
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
+# GET fan-out counters (queued/sent/dropped/evicted) and current queue depths.
+@app.get("/ws/stats")
+def websocket_stats():
+    return manager.snapshot()
+
 # ---------------------
 # API Endpoints
 # ---------------------
@@ -169,265 +319,396 @@ async def websocket_endpoint(websocket: WebSocket):
 def serve_index():
     return FileResponse("static/index.html")
 
+# Liveness: the process is up and serving requests, and startup has not failed.
+@app.get("/healthz")
+def healthz():
+    # A failed startup never becomes ready, so let the liveness probe restart the process.
+    if startup["stage"] == "failed":
+        return JSONResponse({"status": "failed", "error": startup["error"]}, status_code=503)
+    return {"status": "ok"}
+
+# Readiness: the database is reachable, the schema is in place and the station catalog is loaded.
+@app.get("/readyz")
+def readyz():
+    if not (startup["ready"] and catalog.loaded):
+        return JSONResponse({"status": startup["stage"], "error": startup["error"]}, status_code=503)
+    return {"status": "ready", "catalog_version": catalog.version, "station_requirements": len(catalog.all())}
+
+# Prometheus scrape endpoint: per-route latency and DB usage, pool waits, WebSocket fan-out
+# and CSV import timings. Values are per worker process.
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/systems")
-def get_systems():
-    session = SessionLocal()
-    systems = session.query(System).all()
-    session.close()
-    return systems
+async def get_systems(request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    not_modified = conditional(request, response, versions.etag(request, versions.global_version))
+    if not_modified:
+        return not_modified
+    result = await session.execute(select(System))
+    return [{"id": system.id, "name": system.name} for system in result.scalars()]
 
 @app.post("/systems")
-def create_system(system: SystemCreate):
-    session = SessionLocal()
-    existing = session.query(System).filter(System.name == system.name).first()
+async def create_system(system: SystemCreate, session: AsyncSession = Depends(get_session)):
+    existing = await session.scalar(select(System).filter(System.name == system.name))
     if existing:
-        session.close()
         raise HTTPException(status_code=400, detail="System already exists")
     new_system = System(name=system.name)
     session.add(new_system)
-    session.commit()
-    session.refresh(new_system)
-    session.close()
-    return new_system
+    await session.commit()
+    await pubsub.publish(system_ids=[new_system.id])
+    return {"id": new_system.id, "name": new_system.name}
+
+# Optional per-project fields of GET /projects; id, name, system_id,
+# station_requirement_id and the stored totals are always returned.
+PROJECT_LIST_FIELDS = ("requirements", "progress", "station_requirement")
 
-# GET all projects.
+def parse_cursor(after: str, parts: int) -> tuple:
+    # Ids and completions are int4 columns; anything else could only fail in Postgres.
+    values = tuple(int(part) for part in after.split(":"))
+    if len(values) != parts or values[-1] < 0 or not all(-2 ** 31 <= value < 2 ** 31 for value in values):
+        raise ValueError("Invalid cursor")
+    return values
+
+def project_summary(project) -> dict:
+    return {
+        "id": project.id,
+        "name": project.name,
+        "system_id": project.system_id,
+        "station_requirement_id": project.station_requirement_id,
+        "market_id": project.market_id,
+        "total_required": project.total_required,
+        "total_remaining": project.total_remaining,
+        "completion": project.completion
+    }
+
+# GET projects, optionally scoped to one system and filtered/sorted by completion,
+# keyset-paginated. Station requirements are returned once per response, keyed by id.
 @app.get("/projects")
-def list_projects():
-    session = SessionLocal()
-    projects = session.query(Project).options(joinedload(Project.station_requirement)).all()
+async def list_projects(request: Request, response: Response,
+                        system_id: Optional[int] = None,
+                        incomplete: Optional[bool] = Query(None, description="Only projects below (true) or at (false) 100% completion"),
+                        min_completion: Optional[int] = Query(None, ge=0, le=100),
+                        max_completion: Optional[int] = Query(None, ge=0, le=100),
+                        sort: str = Query("id", pattern="^(id|completion|-completion)$"),
+                        after: Optional[str] = Query(None, description="next_cursor from the previous page"),
+                        limit: int = Query(500, ge=1, le=1000),
+                        fields: Optional[str] = Query(None, description="Comma-separated subset of requirements, progress, station_requirement"),
+                        session: AsyncSession = Depends(get_session)):
+    version = versions.global_version if system_id is None else versions.system(system_id)
+    not_modified = conditional(request, response, versions.etag(request, version))
+    if not_modified:
+        return not_modified
+    selected = set(PROJECT_LIST_FIELDS) if fields is None else {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = selected - set(PROJECT_LIST_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    columns = [Project.id, Project.name, Project.system_id, Project.station_requirement_id, Project.market_id,
+               Project.total_required, Project.total_remaining, Project.completion]
+    query = select(*columns)
+    if system_id is not None:
+        query = query.filter(Project.system_id == system_id)
+    if incomplete is not None:
+        query = query.filter(Project.completion < 100 if incomplete else Project.completion >= 100)
+    if min_completion is not None:
+        query = query.filter(Project.completion >= min_completion)
+    if max_completion is not None:
+        query = query.filter(Project.completion <= max_completion)
+    # Cursors are "<id>" when sorting by id and "<completion>:<id>" when sorting by completion.
+    try:
+        if sort == "id":
+            query = query.order_by(Project.id)
+            if after is not None:
+                query = query.filter(Project.id > parse_cursor(after, 1)[0])
+        else:
+            key = tuple_(Project.completion, Project.id)
+            cursor = parse_cursor(after, 2) if after is not None else None
+            if sort == "completion":
+                query = query.order_by(Project.completion, Project.id)
+                if cursor is not None:
+                    query = query.filter(key > tuple_(*cursor))
+            else:
+                query = query.order_by(Project.completion.desc(), Project.id.desc())
+                if cursor is not None:
+                    query = query.filter(key < tuple_(*cursor))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = (await session.execute(query.limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = str(last.id) if sort == "id" else f"{last.completion}:{last.id}"
+    rows = rows[:limit]
+    requirements, progress = {}, {}
+    if selected & {"requirements", "progress"}:
+        requirements, progress = await load_project_commodities(session, [row.id for row in rows])
     results = []
-    for project in projects:
-        station_req = None
-        if project.station_requirement:
-            station_req = {
-                "id": project.station_requirement.id,
-                "tier": project.station_requirement.tier,
-                "location": project.station_requirement.location,
-                "category": project.station_requirement.category,
-                "listed_type": project.station_requirement.listed_type,
-                "building_type": project.station_requirement.building_type,
-                "layout": project.station_requirement.layout,
-                "commodities": {k: v for k, v in project.station_requirement.commodities.items() if v != 0}
-            }
-        total_required = 0
-        total_remaining = 0
-        if station_req and project.progress:
-            for commodity, req in station_req["commodities"].items():
-                total_required += req
-                total_remaining += project.progress.get(commodity, req)
-        completion = round(((total_required - total_remaining) / total_required) * 100) if total_required > 0 else 0
-        results.append({
-            "id": project.id,
-            "name": project.name,
-            "system_id": project.system_id,
-            "station_requirement": station_req,
-            "requirements": project.requirements,
-            "progress": project.progress,
-            "completion": completion
-        })
-    session.close()
-    return results
+    station_requirements = {}
+    for row in rows:
+        project = project_summary(row)
+        if "requirements" in selected:
+            project["requirements"] = requirements.get(row.id)
+        if "progress" in selected:
+            project["progress"] = progress.get(row.id)
+        station_req = catalog.get(row.station_requirement_id)
+        if "station_requirement" in selected and station_req:
+            station_requirements[station_req["id"]] = station_req
+        results.append(project)
+    page = {"projects": results, "next_cursor": next_cursor}
+    if "station_requirement" in selected:
+        page["station_requirements"] = station_requirements
+    return page
 
 # POST /projects to create a new project.
 @app.post("/projects")
-def add_project(project_req: CreateProjectRequest):
-    session = SessionLocal()
-    system = session.query(System).filter(System.id == project_req.system_id).first()
+async def add_project(project_req: CreateProjectRequest, session: AsyncSession = Depends(get_session)):
+    system = await session.get(System, project_req.system_id)
     if not system:
-        session.close()
         raise HTTPException(status_code=404, detail="System not found")
+    station_req = None
+    if project_req.station_requirement_id is not None:
+        station_req = catalog.get(project_req.station_requirement_id)
+        if not station_req:
+            raise HTTPException(status_code=404, detail="Station requirement not found")
     new_project = Project(
         name=project_req.name,
         system_id=project_req.system_id,
-        station_requirement_id=project_req.station_requirement_id
+        station_requirement_id=project_req.station_requirement_id,
+        market_id=project_req.market_id
     )
     # Use the provided requirements override, or fall back to defaults from station_requirement.
+    requirements = {}
     if project_req.requirements is not None:
-        new_project.requirements = project_req.requirements
-        new_project.progress = project_req.requirements.copy()
-    elif new_project.station_requirement and new_project.station_requirement.commodities:
-        defaults = {k: v for k, v in new_project.station_requirement.commodities.items() if v != 0}
-        new_project.requirements = defaults.copy()
-        new_project.progress = defaults.copy()
+        requirements = project_req.requirements
+    elif station_req:
+        requirements = station_req["commodities"]
+    new_project.total_required, new_project.total_remaining = compute_totals(station_req, requirements)
     session.add(new_project)
-    session.commit()
-    session.refresh(new_project)
-    project_id = new_project.id
-    session.close()
-    return {"message": "Project added successfully", "project_id": project_id}
+    try:
+        await session.flush()
+        commodity_ids = await resolve_commodity_ids(session, requirements)
+        session.add_all([
+            ProjectCommodity(project_id=new_project.id, commodity_id=commodity_ids[commodity],
+                             required=amount, remaining=amount)
+            for commodity, amount in requirements.items()
+        ])
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Market ID already linked to another project")
+    await pubsub.publish(system_ids=[new_project.system_id], project_ids=[new_project.id])
+    return {"message": "Project added successfully", "project_id": new_project.id}
 
 # GET a specific project's details.
 @app.get("/projects/{project_id}")
-def get_project(project_id: int):
-    session = SessionLocal()
-    project = session.query(Project).options(joinedload(Project.station_requirement)).filter(Project.id == project_id).first()
+async def get_project(project_id: int, request: Request, response: Response,
+                      session: AsyncSession = Depends(get_session)):
+    not_modified = conditional(request, response, versions.etag(request, versions.project(project_id)))
+    if not_modified:
+        return not_modified
+    project = await session.get(Project, project_id)
     if not project:
-         session.close()
-         raise HTTPException(status_code=404, detail="Project not found")
-    station_req = None
-    if project.station_requirement:
-        station_req = {
-            "id": project.station_requirement.id,
-            "tier": project.station_requirement.tier,
-            "location": project.station_requirement.location,
-            "category": project.station_requirement.category,
-            "listed_type": project.station_requirement.listed_type,
-            "building_type": project.station_requirement.building_type,
-            "layout": project.station_requirement.layout,
-            "commodities": {k: v for k, v in project.station_requirement.commodities.items() if v != 0}
-        }
-    result = {
-         "id": project.id,
-         "name": project.name,
-         "system_id": project.system_id,
-         "station_requirement": station_req,
-         "requirements": project.requirements,
-         "progress": project.progress
+        raise HTTPException(status_code=404, detail="Project not found")
+    requirements, progress = await load_project_commodities(session, [project_id])
+    return {
+        **project_summary(project),
+        "station_requirement": catalog.get(project.station_requirement_id),
+        "requirements": requirements.get(project_id),
+        "progress": progress.get(project_id)
     }
-    session.close()
-    return result
+
+# PUT the in-game depot MarketID of a project (null to unlink), used by journal ingestion.
+@app.put("/projects/{project_id}/market")
+async def link_project_market(project_id: int, payload: MarketLinkRequest, session: AsyncSession = Depends(get_session)):
+    project = await session.get(Project, project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    project.market_id = payload.market_id
+    try:
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Market ID already linked to another project")
+    await pubsub.publish(system_ids=[project.system_id], project_ids=[project_id])
+    return {"message": "Project market updated", "market_id": project.market_id}
 
 # DELETE a project.
 @app.delete("/projects/{project_id}")
-def delete_project(project_id: int):
-    session = SessionLocal()
-    project = session.query(Project).filter(Project.id == project_id).first()
+async def delete_project(project_id: int, session: AsyncSession = Depends(get_session)):
+    project = await session.get(Project, project_id)
     if not project:
-        session.close()
         raise HTTPException(status_code=404, detail="Project not found")
-    session.delete(project)
-    session.commit()
-    session.close()
+    system_id = project.system_id
+    await session.delete(project)
+    await session.commit()
+    await pubsub.publish(system_ids=[system_id], project_ids=[project_id])
     return {"message": "Project deleted successfully"}
 
 # PUT endpoint to update project progress (for updating "Remaining" amounts).
 @app.put("/project_progress/{project_id}")
-async def update_project_progress(project_id: int, payload: UpdateProgressRequest):
+async def update_project_progress(project_id: int, payload: UpdateProgressRequest,
+                                  session: AsyncSession = Depends(get_session)):
     commodity = payload.commodity
     new_remaining = payload.remaining
-    print(f"Updating project {project_id}: setting {commodity} remaining to {new_remaining}")
-    session = SessionLocal()
-    project = session.query(Project).options(joinedload(Project.station_requirement)).filter(Project.id == project_id).first()
-    if not project:
-        session.close()
-        raise HTTPException(status_code=404, detail="Project not found")
-    if project.progress is None:
-        project.progress = {}
-    project.progress[commodity] = new_remaining
-    flag_modified(project, "progress")
-    print(f"Updated progress: {project.progress}")
-    session.commit()
-    updated_progress = project.progress
-    session.close()
-    await manager.broadcast(f'{{"type": "update", "project_id": {project_id}}}')
+    log.debug("Updating project progress", extra={"project_id": project_id, "commodity": commodity,
+                                                   "remaining": new_remaining})
+    patches = {project_id: {commodity: new_remaining}}
+    rows = await apply_progress_patches(session, patches)
+    updated_progress = (await load_project_commodities(session, [project_id]))[1].get(project_id)
+    changes = await build_progress_changes(session, patches, rows)
+    await pubsub.publish({"type": "progress", **changes[0]}, topics=progress_topics(changes),
+                         system_ids=[rows[project_id]["system_id"]], project_ids=[project_id])
     return {"message": "Project progress updated", "progress": updated_progress}
 
+# PUT endpoint to apply many commodity changes, across one or many projects, in one transaction.
+@app.put("/project_progress")
+async def update_project_progress_batch(payload: BatchProgressRequest, session: AsyncSession = Depends(get_session)):
+    if not payload.updates:
+        raise HTTPException(status_code=400, detail="No updates supplied")
+    patches = {}
+    for update in payload.updates:
+        patches.setdefault(update.project_id, {})[update.commodity] = update.remaining
+    rows = await apply_progress_patches(session, patches)
+    changes = await build_progress_changes(session, patches, rows)
+    await pubsub.publish({"type": "progress_batch", "changes": changes}, topics=progress_topics(changes),
+                         system_ids={row["system_id"] for row in rows.values()}, project_ids=rows.keys())
+    progress = (await load_project_commodities(session, rows))[1]
+    return {
+        "message": "Project progress updated",
+        "progress": {project_id: progress.get(project_id) for project_id in rows}
+    }
+
+# POST player journal lines (NDJSON) from ColonisationConstructionDepot and
+# ColonisationContribution events; they are applied at the next flush window.
+@app.post("/journal", status_code=202)
+async def ingest_journal(request: Request, flush: bool = False):
+    counts = {"accepted": 0, "ignored": 0, "invalid": 0}
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            status = journal.submit_line(line)
+            if status:
+                counts[status] += 1
+    status = journal.submit_line(buffer)
+    if status:
+        counts[status] += 1
+    if flush:
+        await journal.flush()
+    return counts
+
+# GET journal ingestion counters.
+@app.get("/journal/stats")
+def journal_stats():
+    return {**journal.stats, "pending_markets": len(journal.pending)}
+
+# GET a streaming export of systems and projects with their progress, either as
+# NDJSON (the format POST /import reads) or as CSV with one row per project commodity.
+@app.get("/export")
+async def export_board(format: str = Query("ndjson", pattern="^(ndjson|csv)$"), system_id: Optional[int] = None):
+    if format == "csv":
+        return StreamingResponse(export_csv(system_id), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="colonytool.csv"'})
+    return StreamingResponse(export_ndjson(system_id), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="colonytool.ndjson"'})
+
+# POST an NDJSON export to create its systems and projects in one transaction.
+# Every record is validated before anything is written.
+@app.post("/import")
+async def import_board(request: Request, session: AsyncSession = Depends(get_session)):
+    lines = (await request.body()).split(b"\n")
+    existing = dict((await session.execute(select(System.name, System.id))).all())
+    parsed = parse_import(lines, existing)
+    try:
+        counts = await import_records(session, parsed, existing)
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Market ID already linked to another project")
+    system_ids = counts.pop("system_ids")
+    await pubsub.publish({"type": "resync"}, topics=[system_topic(system_id) for system_id in system_ids],
+                         system_ids=system_ids)
+    return {"message": "Import complete", **counts}
+
 # GET aggregate system progress.
 @app.get("/systems/{system_id}/aggregate")
-def aggregate_system_progress(system_id: int):
-    session = SessionLocal()
-    projects = session.query(Project).options(joinedload(Project.station_requirement)).filter(Project.system_id == system_id).all()
-    session.close()
-    aggregate = {}
-    required_totals = {}
-    for proj in projects:
-        if proj.station_requirement and proj.station_requirement.commodities and proj.progress:
-            for commodity, req in proj.station_requirement.commodities.items():
-                if req == 0:
-                    continue
-                required_totals[commodity] = required_totals.get(commodity, 0) + req
-                remaining = proj.progress.get(commodity, req)
-                aggregate[commodity] = aggregate.get(commodity, 0) + remaining
-    result = {k: aggregate[k] for k in aggregate if required_totals.get(k, 0) > 0 and aggregate[k] > 0}
-    return result
-
-# Dependent dropdown endpoint for station requirement levels.
+async def aggregate_system_progress(system_id: int, request: Request, response: Response,
+                                    session: AsyncSession = Depends(get_session)):
+    not_modified = conditional(request, response, versions.etag(request, versions.system(system_id)))
+    if not_modified:
+        return not_modified
+    return await compute_system_aggregate(session, system_id)
+
+# GET the delivery runs a system still needs for one or more cargo capacities,
+# e.g. /systems/1/haul_plan?capacity=784&capacity=400.
+@app.get("/systems/{system_id}/haul_plan")
+async def system_haul_plan(system_id: int, request: Request, response: Response,
+                           capacity: List[int] = Query(list(DEFAULT_CAPACITIES)),
+                           session: AsyncSession = Depends(get_session)):
+    if not capacity or len(capacity) > MAX_CAPACITIES or min(capacity) < MIN_CAPACITY:
+        raise HTTPException(status_code=400,
+                            detail=f"Give 1 to {MAX_CAPACITIES} cargo capacities of at least {MIN_CAPACITY}")
+    not_modified = conditional(request, response, versions.etag(request, versions.system(system_id)))
+    if not_modified:
+        return not_modified
+    # Plans are cached already serialized; pass the ETag headers on to the raw response.
+    return Response(content=await planner.plan_json(session, system_id, capacity), media_type="application/json",
+                    headers=dict(response.headers))
+
+# Catalog responses are serialized once per catalog load and revalidated by ETag.
+def catalog_response(request: Request, key, build, cache: bool = True) -> Response:
+    body = catalog.cached_json(key, build) if cache else json.dumps(build()).encode()
+    response = Response(content=body, media_type="application/json")
+    return conditional(request, response, versions.etag(request, 0)) or response
+
+# Dependent dropdown endpoint for station requirement levels (served from the in-memory catalog).
 @app.get("/station_requirements/levels")
-def get_station_levels(level: int = Query(...), tier: Optional[str] = None, location: Optional[str] = None,
+def get_station_levels(request: Request, level: int = Query(...), tier: Optional[str] = None, location: Optional[str] = None,
                        category: Optional[str] = None, listed_type: Optional[str] = None,
                        building_type: Optional[str] = None):
-    session = SessionLocal()
-    query = None
     if level == 1:
-        query = session.query(StationRequirement.tier.distinct())
+        path = ()
     elif level == 2:
         if not tier:
-            session.close()
             raise HTTPException(status_code=400, detail="tier required for level 2 options")
-        query = session.query(StationRequirement.location.distinct()).filter(StationRequirement.tier == tier)
+        path = (tier,)
     elif level == 3:
         if not (tier and location):
-            session.close()
             raise HTTPException(status_code=400, detail="tier and location required for level 3 options")
-        query = session.query(StationRequirement.category.distinct()).filter(
-            StationRequirement.tier == tier,
-            StationRequirement.location == location
-        )
+        path = (tier, location)
     elif level == 4:
         if not (tier and location and category):
-            session.close()
             raise HTTPException(status_code=400, detail="tier, location, and category required for level 4 options")
-        query = session.query(StationRequirement.listed_type.distinct()).filter(
-            StationRequirement.tier == tier,
-            StationRequirement.location == location,
-            StationRequirement.category == category
-        )
+        path = (tier, location, category)
     elif level == 5:
         if not (tier and location and category and listed_type):
-            session.close()
             raise HTTPException(status_code=400, detail="tier, location, category, and listed_type required for level 5 options")
-        query = session.query(StationRequirement.building_type.distinct()).filter(
-            StationRequirement.tier == tier,
-            StationRequirement.location == location,
-            StationRequirement.category == category,
-            StationRequirement.listed_type == listed_type
-        )
+        path = (tier, location, category, listed_type)
     elif level == 6:
         if not (tier and location and category and listed_type and building_type):
-            session.close()
             raise HTTPException(status_code=400, detail="tier, location, category, listed_type, and building_type required for level 6 options")
-        query = session.query(StationRequirement.layout.distinct()).filter(
-            StationRequirement.tier == tier,
-            StationRequirement.location == location,
-            StationRequirement.category == category,
-            StationRequirement.listed_type == listed_type,
-            StationRequirement.building_type == building_type
-        )
+        path = (tier, location, category, listed_type, building_type)
     else:
-        session.close()
         raise HTTPException(status_code=400, detail="Invalid level")
-    options = [row[0] for row in query.all()]
-    session.close()
-    return options
+    # Paths that are not in the catalog are answered uncached, so made-up values cannot grow the cache.
+    return catalog_response(request, ("levels",) + path, lambda: catalog.options(*path), cache=catalog.has_path(*path))
+
+# GET the full station requirement hierarchy so clients can build every dropdown from one request.
+@app.get("/station_requirements/tree")
+def get_station_requirement_tree(request: Request):
+    return catalog_response(request, ("tree",), catalog.tree)
 
 # GET station requirement by 6 levels.
 @app.get("/station_requirements")
-def get_station_requirement(tier: str, location: str, category: str, listed_type: str, building_type: str, layout: str):
-    session = SessionLocal()
-    req = session.query(StationRequirement).filter(
-        StationRequirement.tier == tier,
-        StationRequirement.location == location,
-        StationRequirement.category == category,
-        StationRequirement.listed_type == listed_type,
-        StationRequirement.building_type == building_type,
-        StationRequirement.layout == layout
-    ).first()
-    session.close()
+def get_station_requirement(request: Request, tier: str, location: str, category: str, listed_type: str,
+                            building_type: str, layout: str):
+    req = catalog.find(tier, location, category, listed_type, building_type, layout)
     if not req:
         raise HTTPException(status_code=404, detail="Station requirement not found")
-    return {
-        "id": req.id,
-        "tier": req.tier,
-        "location": req.location,
-        "category": req.category,
-        "listed_type": req.listed_type,
-        "building_type": req.building_type,
-        "layout": req.layout,
-        "commodities": {k: v for k, v in req.commodities.items() if v != 0}
-    }
+    return catalog_response(request, ("requirement", req["id"]), lambda: req)
 
 # POST endpoint to update station requirements from CSV.
 @app.post("/update_station_requirements")
-def update_station_requirements_endpoint():
-    update_station_requirements()
-    return {"message": "Station requirements updated from CSV"}
+async def update_station_requirements_endpoint():
+    counts = await run_in_threadpool(update_station_requirements)
+    await pubsub.publish(catalog_changed=True)
+    return {"message": "Station requirements updated from CSV", **counts}
@@ -0,0 +1,246 @@
+import bisect
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+log = logging.getLogger("colonytool.http")
+
+# Default latency buckets in seconds, as used by the Prometheus client libraries.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# Requests slower than this are logged at WARNING with their DB usage.
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "1.0"))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], object]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # A callback returns the current value (or {label values: value}) at scrape time.
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        values = self.callback() if self.callback else self._values
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labelnames, labels), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{sample} {_format_value(value)}" for sample, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # label values -> [per-bucket counts, sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {labels: ([*counts], total, count) for labels, (counts, total, count) in self._series.items()}
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + _format_labels(names, labels + (_format_value(bound),)), cumulative
+            yield self.name + "_sum" + _format_labels(self.labelnames, labels), total
+            yield self.name + "_count" + _format_labels(self.labelnames, labels), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+# ---------------------
+# Metrics
+# ---------------------
+# Metrics are per process; with several workers, each one reports its own.
+HTTP_REQUESTS = registry.register(Counter(
+    "colonytool_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")))
+HTTP_LATENCY = registry.register(Histogram(
+    "colonytool_http_request_duration_seconds", "HTTP request latency by route.", ("method", "route")))
+HTTP_DB_QUERIES = registry.register(Histogram(
+    "colonytool_http_request_db_queries", "Database queries issued per HTTP request.", ("method", "route"),
+    buckets=COUNT_BUCKETS))
+HTTP_DB_SECONDS = registry.register(Histogram(
+    "colonytool_http_request_db_seconds", "Time spent in database queries per HTTP request.", ("method", "route")))
+DB_POOL_CHECKOUT_WAIT = registry.register(Histogram(
+    "colonytool_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled database connection.", ("engine",)))
+WS_FANOUT_SECONDS = registry.register(Histogram(
+    "colonytool_ws_broadcast_fanout_seconds", "Time to serialize and enqueue one event for every subscriber."))
+WS_QUEUE_DEPTH = registry.register(Histogram(
+    "colonytool_ws_queue_depth", "Depth of a connection's send queue when a message is enqueued.",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500)))
+CSV_IMPORT_SECONDS = registry.register(Histogram(
+    "colonytool_csv_import_duration_seconds", "Station requirements CSV import duration by outcome.", ("result",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)))
+
+
+def register_callback(metric: Metric, callback: Callable[[], object]):
+    """Register a gauge or counter whose value is read at scrape time."""
+    metric.callback = callback
+    registry.register(metric)
+
+# ---------------------
+# Per-request database usage
+# ---------------------
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Set for the duration of each HTTP request; context variables follow the
+# request into SQLAlchemy's greenlets and into run_in_threadpool calls.
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine):
+    """Count queries and their time against the current request."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += time.perf_counter() - context._query_started
+
+
+class _CheckoutTimer:
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started, self.metrics_name)
+
+
+class TimedQueuePool(_CheckoutTimer, QueuePool):
+    """QueuePool that records how long each checkout waited."""
+    metrics_name = "sync"
+
+
+class TimedAsyncQueuePool(_CheckoutTimer, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that records how long each checkout waited."""
+    metrics_name = "async"
+
+# ---------------------
+# HTTP middleware
+# ---------------------
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and DB usage per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = scope.get("route")
+            # Route templates ("/projects/{project_id}") keep the label set small.
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, path, str(status))
+            HTTP_LATENCY.observe(elapsed, method, path)
+            HTTP_DB_QUERIES.observe(stats.queries, method, path)
+            HTTP_DB_SECONDS.observe(stats.db_seconds, method, path)
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                log.warning("Slow request", extra={"method": method, "route": path, "status": status,
+                                                   "duration_ms": round(elapsed * 1000, 1), "db_queries": stats.queries,
+                                                   "db_ms": round(stats.db_seconds * 1000, 1)})
+            elif log.isEnabledFor(logging.DEBUG):
+                log.debug("Request", extra={"method": method, "route": path, "status": status,
+                                            "duration_ms": round(elapsed * 1000, 1), "db_queries": stats.queries,
+                                            "db_ms": round(stats.db_seconds * 1000, 1)})
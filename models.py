@@ -1,10 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import (Column, Integer, SmallInteger, BigInteger, String, DateTime, ForeignKey, UniqueConstraint,
+                        Computed, Index)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+# Whole-percent completion derived from the stored totals.
+COMPLETION_SQL = ("CASE WHEN total_required > 0 "
+                  "THEN round((total_required - total_remaining) * 100.0 / total_required)::integer ELSE 0 END")
+
 
 class System(Base):
     __tablename__ = "systems"
@@ -13,6 +17,19 @@ class System(Base):
     projects = relationship("Project", back_populates="system")
 
 
+# Small key/value store for application bookkeeping, e.g. the hash of the last imported CSV.
+class AppState(Base):
+    __tablename__ = "app_state"
+    key = Column(String(100), primary_key=True)
+    value = Column(String(255), nullable=False)
+
+
+class Commodity(Base):
+    __tablename__ = "commodities"
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String(100), unique=True, nullable=False)
+
+
 class StationRequirement(Base):
     __tablename__ = "station_requirements"
     id = Column(Integer, primary_key=True, index=True)
@@ -22,7 +39,6 @@ class StationRequirement(Base):
     listed_type = Column(String(100), nullable=False)  # Level 4: Listed Type
     building_type = Column(String(100), nullable=False)  # Level 5: Building Type
     layout = Column(String(100), nullable=False)  # Level 6: Facility Layouts
-    commodities = Column(JSONB)  # Commodity amounts stored as JSON
     __table_args__ = (
         UniqueConstraint("tier", "location", "category", "listed_type", "building_type", "layout",
                          name="uix_station_req"),
@@ -33,12 +49,52 @@ class Project(Base):
     __tablename__ = "projects"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False)
-    system_id = Column(Integer, ForeignKey("systems.id"), nullable=False)
+    system_id = Column(Integer, ForeignKey("systems.id"), nullable=False, index=True)
     station_requirement_id = Column(Integer, ForeignKey("station_requirements.id"), nullable=True)
-    # New fields: 'requirements' holds the user-specified target required amounts;
-    # 'progress' holds the current remaining amounts.
-    requirements = Column(JSONB)
-    progress = Column(JSONB)
+    # In-game MarketID of the construction depot, used to match journal events.
+    market_id = Column(BigInteger, unique=True, nullable=True)
+    # Stored totals over the station requirement's commodities, kept in step with
+    # the remaining amounts on create and on every progress write.
+    total_required = Column(Integer, nullable=False, server_default="0")
+    total_remaining = Column(Integer, nullable=False, server_default="0")
+    completion = Column(Integer, Computed(COMPLETION_SQL, persisted=True))
 
     system = relationship("System", back_populates="projects")
     station_requirement = relationship("StationRequirement")
+    __table_args__ = (
+        Index("ix_projects_system_completion", "system_id", "completion", "id"),
+    )
+
+
+# Non-zero commodity amounts of each station requirement.
+class StationRequirementCommodity(Base):
+    __tablename__ = "station_requirement_commodities"
+    station_requirement_id = Column(Integer, ForeignKey("station_requirements.id", ondelete="CASCADE"), primary_key=True)
+    commodity_id = Column(SmallInteger, ForeignKey("commodities.id"), primary_key=True)
+    amount = Column(Integer, nullable=False)
+
+
+# Per-project commodity amounts, one row per commodity the project has either:
+# 'required' holds the user-specified target required amount and 'remaining'
+# the current remaining amount. A project "has progress" once any remaining
+# amount is set.
+class ProjectCommodity(Base):
+    __tablename__ = "project_commodities"
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), primary_key=True)
+    commodity_id = Column(SmallInteger, ForeignKey("commodities.id"), primary_key=True)
+    required = Column(Integer)
+    remaining = Column(Integer)
+    __table_args__ = (
+        Index("ix_project_commodities_commodity", "commodity_id", "remaining"),
+    )
+
+
+# Journal events already applied, keyed by a hash of the whole event, so that
+# re-sent or replayed journals are not counted twice. Rows older than a market's
+# latest depot snapshot are pruned, as that snapshot already includes them.
+class JournalEvent(Base):
+    __tablename__ = "journal_events"
+    market_id = Column(BigInteger, primary_key=True)
+    event_key = Column(String(64), primary_key=True)
+    kind = Column(String(20), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
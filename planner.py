@@ -0,0 +1,177 @@
+import json
+from collections import OrderedDict
+from typing import List, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from catalog import catalog
+from models import Project, ProjectCommodity
+
+# Large and medium ship holds, matching the "# Trips" columns of the CSV.
+DEFAULT_CAPACITIES = (784, 400)
+MAX_CAPACITIES = 8
+# Smallest hold a plan is computed for; real haulers carry far more.
+MIN_CAPACITY = 8
+
+
+class HaulPlanner:
+    """Plans delivery runs for a system from a (projects x commodities) matrix.
+
+    Remaining amounts follow the same rules as compute_totals() and the system
+    aggregate: only projects with progress and a station requirement count, a
+    commodity missing from progress counts as its full requirement, and zero
+    requirement amounts are ignored. Plans are cached per system version
+    (and epoch, so ChangeVersions.reset() drops them).
+    """
+
+    def __init__(self, versions, cache_size: int = 256):
+        self.versions = versions
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        # (catalog version, commodity names by id, requirement id -> row,
+        #  requirement matrix), rebuilt when the catalog is reloaded.
+        self._defaults = None
+
+    async def plan_json(self, session: AsyncSession, system_id: int, capacities: Sequence[int]) -> bytes:
+        """Serialized plan for the system, computed once per system version."""
+        capacities = tuple(capacities)
+        # Read the version before the data, as the ETags do, so a cached plan is
+        # never labelled newer than what it was computed from.
+        key = (system_id, self.versions.epoch, self.versions.system(system_id), catalog.version, capacities)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+        projects = (await session.execute(
+            select(Project.id, Project.station_requirement_id)
+            .filter(Project.system_id == system_id, Project.station_requirement_id.isnot(None))
+            .order_by(Project.id)
+        )).all()
+        amounts = (await session.execute(
+            select(ProjectCommodity.project_id, ProjectCommodity.commodity_id, ProjectCommodity.remaining)
+            .join(Project, Project.id == ProjectCommodity.project_id)
+            .filter(Project.system_id == system_id, ProjectCommodity.remaining.isnot(None))
+        )).all()
+        body = await run_in_threadpool(self._plan_body, projects, amounts, capacities)
+        self._cache[key] = body
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return body
+
+    def _plan_body(self, projects, amounts, capacities) -> bytes:
+        # CPU-bound, so plan_json runs it off the event loop.
+        project_ids, remaining, commodities = self._remaining_matrix(projects, amounts)
+        return json.dumps(build_plan(project_ids, remaining, commodities, capacities)).encode()
+
+    def _requirement_matrix(self):
+        # numpy is only needed for planning, so it is loaded on first use.
+        import numpy as np
+        if self._defaults is None or self._defaults[0] != catalog.version:
+            commodity_ids = catalog.commodity_ids()
+            # Columns are commodity ids, so stored amounts need no name lookups.
+            names = [None] * (max(commodity_ids.values(), default=0) + 1)
+            for name, commodity_id in commodity_ids.items():
+                names[commodity_id] = name
+            requirements = catalog.all()
+            rows = {req_id: i for i, req_id in enumerate(requirements)}
+            matrix = np.zeros((len(rows), len(names)), dtype=np.int64)
+            for req_id, req in requirements.items():
+                for commodity, amount in req["commodities"].items():
+                    matrix[rows[req_id], commodity_ids[commodity]] = amount
+            self._defaults = (catalog.version, names, rows, matrix)
+        return self._defaults[1:]
+
+    def _remaining_matrix(self, projects, amounts) -> Tuple[List[int], "np.ndarray", List[str]]:
+        import numpy as np
+        names, rows, requirements = self._requirement_matrix()
+        projects = [p for p in projects if p.station_requirement_id in rows]
+        if not projects or not amounts:
+            return [], np.zeros((0, len(names)), dtype=np.int64), names
+        ids = np.array([p.id for p in projects], dtype=np.int64)
+        # Start every project at its station's full requirement, then overlay the
+        # remaining amounts that are set.
+        remaining = requirements[[rows[p.station_requirement_id] for p in projects]]
+        project_id, commodity_id, value = (np.array(column, dtype=np.int64) for column in zip(*amounts))
+        row = np.minimum(np.searchsorted(ids, project_id), len(ids) - 1)
+        found = ids[row] == project_id
+        has_progress = np.zeros(len(ids), dtype=bool)
+        has_progress[row[found]] = True
+        # Commodities added after the catalog was loaded are in no station requirement.
+        known = found & (commodity_id < len(names))
+        overlay = remaining.copy()
+        overlay[row[known], commodity_id[known]] = value[known]
+        remaining = np.where(remaining != 0, overlay, 0)[has_progress]
+        ids = ids[has_progress]
+        return ids.tolist(), np.clip(remaining, 0, None), names
+
+
+def build_plan(project_ids: List[int], remaining: "np.ndarray", commodities: List[str],
+               capacities: Sequence[int]) -> dict:
+    import numpy as np
+    totals = remaining.sum(axis=0)
+    per_project = remaining.sum(axis=1)
+    order = sorted(np.flatnonzero(totals), key=lambda j: (-totals[j], commodities[j]))
+    total = int(totals.sum())
+    caps = np.asarray(capacities, dtype=np.int64)
+    # Ceiling division over every (commodity, capacity) and (project, capacity) pair at once.
+    commodity_trips = -(-totals[order][:, None] // caps)
+    project_trips = -(-per_project[:, None] // caps)
+    return {
+        "total_remaining": total,
+        "capacities": [{
+            "capacity": int(cap),
+            "total_trips": -(-total // int(cap)),
+            "commodities": [
+                {"commodity": commodities[j], "remaining": int(totals[j]), "trips": int(commodity_trips[n, k])}
+                for n, j in enumerate(order)
+            ],
+            "projects": [
+                {"project_id": project_id, "remaining": int(per_project[i]), "trips": int(project_trips[i, k])}
+                for i, project_id in enumerate(project_ids)
+            ],
+            "plan": pack_holds(totals[order], [commodities[j] for j in order], int(cap))
+        } for k, cap in enumerate(caps)]
+    }
+
+
+def pack_holds(amounts: Sequence[int], commodities: List[str], capacity: int) -> List[dict]:
+    """Greedily fill holds of the given capacity, largest commodity first.
+
+    Cargo is laid end to end and cut every `capacity` units, so every trip but the
+    last is full and the trip count is minimal. Consecutive full loads of a single
+    commodity are returned as one step with a trip count and the cargo of one trip.
+    """
+    plan = []
+    loaded = 0
+    # Cargo of the trip being filled, which mixes commodities or is the partial last one.
+    hold = {}
+
+    def ship_hold():
+        plan.append({"first_trip": (loaded - 1) // capacity + 1, "trips": 1, "cargo": dict(hold)})
+        hold.clear()
+
+    # Each commodity tops up the open hold, then fills whole holds, then starts a new one.
+    for name, amount in zip(commodities, amounts):
+        left = int(amount)
+        if left <= 0:
+            continue
+        if hold:
+            take = min(left, capacity - loaded % capacity)
+            hold[name] = take
+            loaded += take
+            left -= take
+            if loaded % capacity == 0:
+                ship_hold()
+        full = left // capacity
+        if full:
+            plan.append({"first_trip": loaded // capacity + 1, "trips": full, "cargo": {name: capacity}})
+            loaded += full * capacity
+            left -= full * capacity
+        if left:
+            hold[name] = left
+            loaded += left
+    if hold:
+        ship_hold()
+    return plan
@@ -0,0 +1,248 @@
+import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from catalog import catalog
+from connections import system_topic, project_topic
+
+# ---------------------
+# Project Totals
+# ---------------------
+# A project's totals are taken over its station requirement's non-zero
+# commodities, with a commodity missing from progress counting as its full
+# requirement. Projects without progress have 0/0 totals and 0% completion.
+def compute_totals(station_req: Optional[dict], progress: Optional[dict]) -> Tuple[int, int]:
+    total_required = 0
+    total_remaining = 0
+    if station_req and progress:
+        for commodity, req in station_req["commodities"].items():
+            total_required += req
+            total_remaining += progress.get(commodity, req)
+    return total_required, total_remaining
+
+
+# A project has progress once any of its remaining amounts is set.
+_HAS_PROGRESS = ("EXISTS (SELECT 1 FROM project_commodities AS x "
+                 "WHERE x.project_id = p.id AND x.remaining IS NOT NULL)")
+_REQUIRED = (f"CASE WHEN {_HAS_PROGRESS} THEN COALESCE((SELECT SUM(src.amount) "
+             f"FROM station_requirement_commodities AS src "
+             f"WHERE src.station_requirement_id = p.station_requirement_id), 0) ELSE 0 END")
+_REMAINING = (f"CASE WHEN {_HAS_PROGRESS} THEN COALESCE((SELECT SUM(COALESCE(pc.remaining, src.amount)) "
+              f"FROM station_requirement_commodities AS src "
+              f"LEFT JOIN project_commodities AS pc ON pc.project_id = p.id AND pc.commodity_id = src.commodity_id "
+              f"WHERE src.station_requirement_id = p.station_requirement_id), 0) ELSE 0 END")
+_TOTALS_UPDATE = f"""
+    UPDATE projects AS p
+    SET total_required = t.total_required, total_remaining = t.total_remaining
+    FROM (SELECT p.id, {_REQUIRED} AS total_required, {_REMAINING} AS total_remaining
+          FROM projects AS p {{where}}) AS t
+    WHERE p.id = t.id {{changed}}
+"""
+
+# Refreshes the stored totals of the given projects after a progress write.
+TOTALS_UPDATE_SQL = text(_TOTALS_UPDATE.format(where="WHERE p.id = ANY(:project_ids)", changed="") + """
+    RETURNING p.id, p.system_id, p.station_requirement_id, p.total_required, p.total_remaining, p.completion
+""")
+
+# Re-derives stored totals for every project, e.g. after the CSV reload changed
+# station requirement amounts. Rows that are already correct are not rewritten.
+RECOMPUTE_TOTALS_SQL = text(_TOTALS_UPDATE.format(
+    where="", changed="AND (p.total_required, p.total_remaining) IS DISTINCT FROM (t.total_required, t.total_remaining)"
+))
+
+# Totals are computed from other tables, so writers lock the project rows first;
+# statements after the lock see every earlier writer's committed amounts.
+LOCK_PROJECTS_SQL = text("SELECT id FROM projects WHERE id = ANY(:project_ids) ORDER BY id FOR UPDATE")
+LOCK_ALL_PROJECTS_SQL = text("SELECT id FROM projects ORDER BY id FOR UPDATE")
+
+# Adds commodities that are not known yet, keeping the given order for their ids.
+REGISTER_COMMODITIES_SQL = text("""
+    INSERT INTO commodities (name)
+    SELECT t.name FROM unnest(CAST(:names AS varchar[])) WITH ORDINALITY AS t(name, position)
+    WHERE NOT EXISTS (SELECT 1 FROM commodities AS c WHERE c.name = t.name)
+    ORDER BY t.position
+    ON CONFLICT (name) DO NOTHING
+""")
+COMMODITY_IDS_SQL = text("SELECT name, id FROM commodities WHERE name = ANY(:names)")
+# Width of commodities.name.
+MAX_COMMODITY_NAME_LENGTH = 100
+
+# Sets each (project, commodity) of v to 'remaining' (absolute) and subtracts
+# 'delivered'. A delivered commodity without a remaining amount yet counts
+# down from the project's (or station's) requirement.
+PROGRESS_UPSERT_SQL = text("""
+    INSERT INTO project_commodities AS pc (project_id, commodity_id, remaining)
+    SELECT v.project_id, v.commodity_id,
+           CASE WHEN v.delivered IS NULL THEN v.remaining
+                ELSE GREATEST(COALESCE(v.remaining, cur.remaining, cur.required, src.amount, 0) - v.delivered, 0) END
+    FROM jsonb_to_recordset(CAST(:changes AS jsonb))
+         AS v(project_id integer, commodity_id smallint, remaining integer, delivered integer)
+    JOIN projects AS p ON p.id = v.project_id
+    LEFT JOIN project_commodities AS cur ON cur.project_id = v.project_id AND cur.commodity_id = v.commodity_id
+    LEFT JOIN station_requirement_commodities AS src
+           ON src.station_requirement_id = p.station_requirement_id AND src.commodity_id = v.commodity_id
+    ON CONFLICT (project_id, commodity_id) DO UPDATE SET remaining = EXCLUDED.remaining
+    RETURNING pc.project_id, pc.commodity_id, pc.remaining
+""")
+
+# Required and remaining amounts of the given projects, in commodity order.
+PROJECT_COMMODITIES_SQL = text("""
+    SELECT pc.project_id, c.name, pc.required, pc.remaining
+    FROM project_commodities AS pc JOIN commodities AS c ON c.id = pc.commodity_id
+    WHERE pc.project_id = ANY(:project_ids)
+    ORDER BY pc.project_id, pc.commodity_id
+""")
+
+
+def recompute_totals(session):
+    """Re-derive every project's stored totals (sync session, not committed)."""
+    session.execute(LOCK_ALL_PROJECTS_SQL)
+    session.execute(RECOMPUTE_TOTALS_SQL)
+
+# ---------------------
+# Progress Writes
+# ---------------------
+async def resolve_commodity_ids(session: AsyncSession, names: Iterable[str]) -> Dict[str, int]:
+    """Commodity ids by name; raises 400 for commodities that are not in the catalog.
+
+    Only the station requirements CSV adds commodities, so client input cannot
+    grow the commodities table.
+    """
+    names = list(dict.fromkeys(names))
+    known = catalog.commodity_ids()
+    ids = {name: known[name] for name in names if name in known}
+    missing = [name for name in names if name not in ids]
+    if missing:
+        # Another worker may have imported a newer CSV before this one reloaded its catalog.
+        lookup = [name for name in missing if len(name) <= MAX_COMMODITY_NAME_LENGTH]
+        if lookup:
+            ids.update((await session.execute(COMMODITY_IDS_SQL, {"names": lookup})).all())
+        unknown = [name for name in missing if name not in ids]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown commodity: {', '.join(unknown[:10])}")
+    return ids
+
+
+async def write_progress(session: AsyncSession, patches: Dict[int, Dict[str, int]],
+                         deltas: Optional[Dict[int, Dict[str, int]]] = None) -> Dict[int, dict]:
+    """Set remaining amounts ({project_id: {commodity: remaining}}) and subtract
+    delivered amounts ({project_id: {commodity: delivered}}) without committing.
+
+    Returns the updated rows keyed by project id, each with the new 'remaining'
+    amount of every touched commodity; unknown projects are skipped and unknown
+    commodities raise 400.
+    """
+    deltas = deltas or {}
+    project_ids = sorted(set(patches) | set(deltas))
+    await session.execute(LOCK_PROJECTS_SQL, {"project_ids": project_ids})
+    ids = await resolve_commodity_ids(session, [c for changes in (patches, deltas)
+                                                for amounts in changes.values() for c in amounts])
+    names = {commodity_id: name for name, commodity_id in ids.items()}
+    changes = {}
+    for project_id, amounts in patches.items():
+        for commodity, remaining in amounts.items():
+            changes[project_id, ids[commodity]] = {"remaining": remaining, "delivered": None}
+    for project_id, amounts in deltas.items():
+        for commodity, delivered in amounts.items():
+            changes.setdefault((project_id, ids[commodity]), {"remaining": None})["delivered"] = delivered
+    payload = json.dumps([{"project_id": project_id, "commodity_id": commodity_id, **change}
+                          for (project_id, commodity_id), change in changes.items()])
+    written = (await session.execute(PROGRESS_UPSERT_SQL, {"changes": payload})).all()
+    result = await session.execute(TOTALS_UPDATE_SQL, {"project_ids": project_ids})
+    rows = {row.id: {**row._asdict(), "remaining": {}} for row in result}
+    for row in written:
+        rows[row.project_id]["remaining"][names[row.commodity_id]] = row.remaining
+    return rows
+
+
+async def apply_progress_patches(session: AsyncSession, patches: Dict[int, Dict[str, int]]) -> Dict[int, dict]:
+    """Apply {project_id: {commodity: remaining}} and return the updated rows keyed by project id.
+
+    Raises 404 (and leaves the transaction uncommitted) if any project does not exist.
+    """
+    rows = await write_progress(session, patches)
+    missing = sorted(set(patches) - set(rows))
+    if missing:
+        await session.rollback()
+        raise HTTPException(status_code=404, detail=f"Project not found: {', '.join(map(str, missing))}")
+    await session.commit()
+    return rows
+
+
+async def load_project_commodities(session: AsyncSession, project_ids: Iterable[int]) -> Tuple[Dict[int, dict], Dict[int, dict]]:
+    """Name-keyed ({project_id: requirements}, {project_id: progress}) for the given projects.
+
+    Projects without any required (or remaining) amount are left out of the first (or second) map.
+    """
+    requirements, progress = {}, {}
+    result = await session.execute(PROJECT_COMMODITIES_SQL, {"project_ids": list(project_ids)})
+    for row in result:
+        if row.required is not None:
+            requirements.setdefault(row.project_id, {})[row.name] = row.required
+        if row.remaining is not None:
+            progress.setdefault(row.project_id, {})[row.name] = row.remaining
+    return requirements, progress
+
+
+async def build_progress_changes(session: AsyncSession, touched: Dict[int, Iterable[str]], rows: Dict[int, dict]) -> List[dict]:
+    """Describe the new state of each touched {project_id: commodities} for broadcasting."""
+    by_system = {}
+    for project_id, commodities in touched.items():
+        by_system.setdefault(rows[project_id]["system_id"], set()).update(commodities)
+    aggregates = {}
+    for system_id, commodities in by_system.items():
+        aggregates[system_id] = await compute_system_aggregate(session, system_id, sorted(commodities))
+    changes = []
+    for project_id, commodities in touched.items():
+        row = rows[project_id]
+        for commodity in commodities:
+            changes.append({
+                "project_id": project_id,
+                "system_id": row["system_id"],
+                "commodity": commodity,
+                "remaining": row["remaining"].get(commodity),
+                "completion": row["completion"],
+                "total_required": row["total_required"],
+                "total_remaining": row["total_remaining"],
+                "aggregate": {"commodity": commodity, "remaining": aggregates[row["system_id"]].get(commodity, 0)}
+            })
+    return changes
+
+
+def progress_topics(changes: List[dict]) -> Set[str]:
+    topics = set()
+    for change in changes:
+        topics.add(system_topic(change["system_id"]))
+        topics.add(project_topic(change["project_id"]))
+    return topics
+
+# ---------------------
+# System Aggregate
+# ---------------------
+# Sums each commodity's remaining amount over the system's projects, with the
+# same rules as compute_totals(). Commodities with nothing remaining are left out.
+SYSTEM_AGGREGATE_SQL = f"""
+    SELECT c.name AS commodity, SUM(COALESCE(pc.remaining, src.amount)) AS remaining
+    FROM projects AS p
+    JOIN station_requirement_commodities AS src ON src.station_requirement_id = p.station_requirement_id
+    JOIN commodities AS c ON c.id = src.commodity_id
+    LEFT JOIN project_commodities AS pc ON pc.project_id = p.id AND pc.commodity_id = src.commodity_id
+    WHERE p.system_id = :system_id AND {_HAS_PROGRESS}
+      {{commodity_filter}}
+    GROUP BY c.name
+    HAVING SUM(COALESCE(pc.remaining, src.amount)) > 0
+    ORDER BY c.name
+"""
+SYSTEM_AGGREGATE_ALL = text(SYSTEM_AGGREGATE_SQL.format(commodity_filter=""))
+SYSTEM_AGGREGATE_FOR = text(SYSTEM_AGGREGATE_SQL.format(commodity_filter="AND c.name = ANY(:commodities)"))
+
+
+async def compute_system_aggregate(session: AsyncSession, system_id: int, commodities: Optional[List[str]] = None) -> dict:
+    if commodities is None:
+        result = await session.execute(SYSTEM_AGGREGATE_ALL, {"system_id": system_id})
+    else:
+        result = await session.execute(SYSTEM_AGGREGATE_FOR, {"system_id": system_id, "commodities": list(commodities)})
+    return {row.commodity: row.remaining for row in result}
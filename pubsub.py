@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Iterable, Optional
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from catalog import catalog
+from connections import ConnectionManager
+from database import DATABASE_URL, SessionLocal, async_engine
+from versions import ChangeVersions
+
+log = logging.getLogger("colonytool.pubsub")
+
+NOTIFY_CHANNEL = "colonytool_events"
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; larger events are
+# replaced by a "resync" notice for the same topics.
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+class LocalPubSub:
+    """Delivers change notifications to this process only (the default).
+
+    A notification bumps the ETag change versions and, if it carries a
+    WebSocket event, broadcasts it to the matching local subscribers.
+    """
+
+    def __init__(self, manager: ConnectionManager, versions: ChangeVersions):
+        self.manager = manager
+        self.versions = versions
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Optional[dict] = None, topics: Optional[Iterable[str]] = None,
+                      system_ids: Iterable[int] = (), project_ids: Iterable[int] = (), catalog_changed: bool = False):
+        self.deliver({
+            "event": event,
+            "topics": None if topics is None else sorted(topics),
+            "systems": sorted(system_ids),
+            "projects": sorted(project_ids),
+            "catalog": catalog_changed
+        })
+
+    def deliver(self, message: dict):
+        self.versions.bump(message["systems"], message["projects"])
+        if message.get("event") is not None:
+            self.manager.broadcast_event(message["event"], topics=message["topics"])
+        elif message.get("resync"):
+            self.manager.broadcast_event({"type": "resync"}, topics=message["topics"])
+
+
+class PostgresPubSub(LocalPubSub):
+    """Relays notifications between workers and replicas through Postgres NOTIFY.
+
+    Each process applies its own notifications immediately and also NOTIFYs
+    them; one LISTEN connection per process relays everybody else's to local
+    sockets. If the LISTEN connection drops, all change versions are reset and
+    local clients are told to resync, since notifications may have been missed
+    while it was down.
+    """
+
+    def __init__(self, manager: ConnectionManager, versions: ChangeVersions, reconnect_delay: float = 2.0):
+        super().__init__(manager, versions)
+        self.origin = uuid.uuid4().hex
+        self.reconnect_delay = reconnect_delay
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.listener = asyncio.create_task(self._listen_forever())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+
+    async def publish(self, event: Optional[dict] = None, topics: Optional[Iterable[str]] = None,
+                      system_ids: Iterable[int] = (), project_ids: Iterable[int] = (), catalog_changed: bool = False):
+        message = {
+            "origin": self.origin,
+            "event": event,
+            "topics": None if topics is None else sorted(topics),
+            "systems": sorted(system_ids),
+            "projects": sorted(project_ids),
+            "catalog": catalog_changed
+        }
+        self.deliver(message)
+        payload = json.dumps(message)
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            payload = json.dumps({**message, "event": None, "resync": event is not None})
+        # The caller's write has already committed and local clients are up to
+        # date, so a failed NOTIFY is logged rather than failing the request.
+        # Other processes then miss this change: their clients keep getting 304s
+        # for it until a later change to the same system or project, or until
+        # their listener reconnects and resets all versions.
+        try:
+            async with async_engine.connect() as connection:
+                await connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                         {"channel": NOTIFY_CHANNEL, "payload": payload})
+                await connection.commit()
+        except Exception as e:
+            log.warning("Change notification not sent to other processes", extra={"error": str(e)})
+
+    async def _listen_forever(self):
+        dsn = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+        first = True
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                closed = asyncio.get_running_loop().create_future()
+                connection.add_termination_listener(lambda _: closed.done() or closed.set_result(None))
+                await connection.add_listener(NOTIFY_CHANNEL, self._on_notify)
+                if not first:
+                    # Notifications missed while disconnected may touch any system or
+                    # project, so invalidate every ETag before telling clients to refetch.
+                    self.versions.reset()
+                    self.manager.broadcast_event({"type": "resync"})
+                first = False
+                log.info("Listening for change notifications", extra={"channel": NOTIFY_CHANNEL})
+                await closed
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Change notification listener error", extra={"error": str(e)})
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+        if message.get("origin") == self.origin:
+            return
+        self.deliver(message)
+        if message.get("catalog"):
+            asyncio.create_task(self._reload_catalog())
+
+    async def _reload_catalog(self):
+        def load():
+            session = SessionLocal()
+            try:
+                catalog.load(session)
+            finally:
+                session.close()
+        await asyncio.to_thread(load)
+
+
+def create_pubsub(manager: ConnectionManager, versions: ChangeVersions) -> LocalPubSub:
+    backend = os.getenv("PUBSUB_BACKEND", "memory").strip().lower()
+    if backend == "postgres":
+        return PostgresPubSub(manager, versions)
+    if backend != "memory":
+        raise ValueError(f"Unknown PUBSUB_BACKEND: {backend}")
+    return LocalPubSub(manager, versions)
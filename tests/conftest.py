@@ -0,0 +1,12 @@
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(REPO_ROOT, "fixtures", "journal")
+
+sys.path.insert(0, REPO_ROOT)
+
+# Tests that need Postgres run against TEST_DATABASE_URL and are skipped without it.
+# It must be set before the app modules create their engines.
+if os.getenv("TEST_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
@@ -0,0 +1,242 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+import journal
+from conftest import FIXTURES, REPO_ROOT
+from journal import JournalIngestor, MarketEvents
+
+DEPOT = 3952123394
+PLANETARY_DEPOT = 3952123650
+UNKNOWN_DEPOT = 3700000001
+
+# Commodity columns of StationRequirements.csv used by the fixtures.
+CATALOG_COMMODITIES = [
+    "Liquid Oxygen", "Water", "Ceramic Composites", "CMM Composite", "Insulating Membrane", "Polymers",
+    "Semiconductors", "Superconductors", "Aluminium", "Copper", "Steel", "Titanium", "Computer Components",
+    "Medical Diagnostic Equipment", "Food Cartridges", "Fruit and Vegetables", "Non-Lethal Weapons",
+    "Power Generators", "Water Purifiers",
+]
+
+
+class StubCatalog:
+    version = 1
+
+    def all(self):
+        return {1: {"commodities": {name: 1 for name in CATALOG_COMMODITIES}}}
+
+
+class StubPubSub:
+    def __init__(self, error=None):
+        self.error = error
+        self.published = []
+
+    async def publish(self, event=None, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.published.append(event)
+
+
+class StubSession:
+    def __init__(self):
+        self.commits = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def commit(self):
+        self.commits += 1
+
+
+def fixture_lines():
+    lines = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.log"))):
+        with open(path, encoding="utf-8") as f:
+            lines.extend(f)
+    return lines
+
+
+@pytest.fixture
+def ingestor(monkeypatch):
+    monkeypatch.setattr(journal, "catalog", StubCatalog())
+    return JournalIngestor(StubPubSub())
+
+
+def test_fixtures_map_onto_catalog_commodities(ingestor):
+    statuses = [ingestor.submit_line(line) for line in fixture_lines()]
+    assert statuses.count("accepted") == 8
+    assert "invalid" not in statuses
+    assert ingestor.stats["unmatched_resources"] == 0
+    assert set(ingestor.pending) == {DEPOT, PLANETARY_DEPOT, UNKNOWN_DEPOT}
+
+    # The later depot snapshot replaces the first; it already counts the first Steel delivery.
+    depot = ingestor.pending[DEPOT]
+    assert depot.depot[0] == datetime(2025, 4, 9, 18, 43, 25)
+    assert depot.depot[2]["Steel"] == 14076 - 784
+    assert depot.depot[2]["CMM Composite"] == 11261
+    assert len(depot.depot[2]) == len(CATALOG_COMMODITIES)
+    assert sorted((amounts for _, amounts in depot.contributions.values()), key=json.dumps) == sorted([
+        {"Steel": 784}, {"Aluminium": 500, "Copper": 200, "Water Purifiers": 84}, {"Steel": 784},
+    ], key=json.dumps)
+
+    planetary = ingestor.pending[PLANETARY_DEPOT]
+    assert planetary.depot is None
+    assert sorted((amounts for _, amounts in planetary.contributions.values()), key=json.dumps) == sorted([
+        {"CMM Composite": 400}, {"CMM Composite": 400, "Titanium": 384},
+    ], key=json.dumps)
+
+
+def test_resolver_uses_internal_names_and_aliases(monkeypatch):
+    catalog = StubCatalog()
+    catalog.all = lambda: {1: {"commodities": {"CMM Composite": 1, "Land Enrichment Systems": 1}}}
+    monkeypatch.setattr(journal, "catalog", catalog)
+    resolver = journal.CommodityResolver()
+    assert resolver.resolve({"Name": "$CMMComposite_name;"}) == "CMM Composite"
+    assert resolver.resolve({"Name": "$TerrainEnrichmentSystems_name;", "Name_Localised": "?"}) == "Land Enrichment Systems"
+    assert resolver.resolve({"Name": "$Unobtainium_name;", "Name_Localised": "Unobtainium"}) is None
+
+
+def test_resent_events_are_coalesced_once(ingestor):
+    for line in fixture_lines():
+        ingestor.submit_line(line)
+    first = {market_id: (market.depot, dict(market.contributions)) for market_id, market in ingestor.pending.items()}
+    for line in fixture_lines():
+        ingestor.submit_line(line)
+    assert {market_id: (market.depot, market.contributions) for market_id, market in ingestor.pending.items()} == first
+
+
+def test_requeue_keeps_newer_events_on_top(ingestor):
+    lines = fixture_lines()
+    for line in lines[:5]:
+        ingestor.submit_line(line)
+    failed, ingestor.pending = ingestor.pending, {}
+    for line in lines[5:]:
+        ingestor.submit_line(line)
+    ingestor._requeue(failed)
+
+    merged = JournalIngestor(StubPubSub())
+    for line in lines:
+        merged.submit_line(line)
+    assert set(ingestor.pending) == set(merged.pending)
+    for market_id, market in merged.pending.items():
+        assert ingestor.pending[market_id].depot == market.depot
+        assert ingestor.pending[market_id].contributions == market.contributions
+
+
+def test_failed_write_is_requeued(ingestor, monkeypatch):
+    monkeypatch.setattr(journal, "AsyncSessionLocal", StubSession)
+
+    async def fail(session, pending):
+        raise ConnectionError("database went away")
+    monkeypatch.setattr(ingestor, "_apply", fail)
+    for line in fixture_lines():
+        ingestor.submit_line(line)
+    pending = ingestor.pending
+    assert asyncio.run(ingestor.flush()) == []
+    assert ingestor.pending is pending
+
+
+def test_failed_broadcast_does_not_reapply_a_committed_batch(monkeypatch):
+    monkeypatch.setattr(journal, "catalog", StubCatalog())
+    monkeypatch.setattr(journal, "AsyncSessionLocal", StubSession)
+    ingestor = JournalIngestor(StubPubSub(error=ConnectionError("NOTIFY failed")))
+    applied = []
+
+    async def apply(session, pending):
+        applied.append(pending)
+        return {1: {"system_id": 1}}, {1: {"Steel"}}
+    monkeypatch.setattr(ingestor, "_apply", apply)
+
+    async def changes(session, touched, rows):
+        return [{"project_id": 1, "system_id": 1, "commodity": "Steel"}]
+    monkeypatch.setattr(journal, "build_progress_changes", changes)
+
+    for line in fixture_lines():
+        ingestor.submit_line(line)
+    assert asyncio.run(ingestor.flush()) == []
+    assert ingestor.pending == {}
+    asyncio.run(ingestor.flush())
+    assert len(applied) == 1
+    assert ingestor.stats["flushes"] == 1
+
+
+def test_market_events_keep_the_latest_depot():
+    market = MarketEvents()
+    market.add_depot(datetime(2025, 4, 9, 18, 43, 25), "b", {"Steel": 2})
+    market.add_depot(datetime(2025, 4, 9, 18, 42, 11), "a", {"Steel": 3})
+    assert market.depot[1] == "b"
+    market.add_depot(datetime(2025, 4, 9, 18, 43, 25), "c", {"Steel": 1})
+    assert market.depot[1] == "c"
+
+
+@pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL is not set")
+def test_replayed_fixtures_are_applied_once(monkeypatch):
+    monkeypatch.chdir(REPO_ROOT)
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as client:
+        deadline = time.monotonic() + 60
+        while client.get("/readyz").status_code != 200:
+            assert time.monotonic() < deadline, "server did not become ready"
+            time.sleep(0.1)
+        req = next(r for r in main.catalog.all().values() if r["commodities"].get("Steel") == 14076)
+        system_id = client.post("/systems", json={"name": f"Journal test {random.random()}"}).json()["id"]
+        # Fresh market ids, so earlier runs' recorded events do not count as duplicates.
+        base = random.randrange(10 ** 11, 10 ** 12)
+        markets = {DEPOT: base, PLANETARY_DEPOT: base + 1}
+        projects = {
+            depot: client.post("/projects", json={"name": str(depot), "system_id": system_id,
+                                                   "station_requirement_id": req["id"], "market_id": market_id}
+                                ).json()["project_id"]
+            for depot, market_id in markets.items()
+        }
+        lines = []
+        for line in fixture_lines():
+            event = json.loads(line)
+            if "MarketID" in event:
+                event["MarketID"] = markets.get(event["MarketID"], event["MarketID"])
+            lines.append(json.dumps(event))
+        body = "\n".join(lines)
+
+        def progress():
+            return {depot: client.get(f"/projects/{project_id}").json()["progress"]
+                    for depot, project_id in projects.items()}
+        try:
+            assert client.post("/journal?flush=true", content=body).status_code == 202
+            once = progress()
+            assert once[DEPOT]["Steel"] == 14076 - 784 - 784
+            assert once[DEPOT]["Aluminium"] == 10055 - 500
+            assert once[PLANETARY_DEPOT]["CMM Composite"] == 11261 - 800
+            assert once[PLANETARY_DEPOT]["Titanium"] == 8205 - 384
+
+            client.post("/journal?flush=true", content=body)
+            client.post("/journal?flush=true", content="\n".join(lines[:8]))
+            client.post("/journal?flush=true", content="\n".join(lines[8:]))
+            assert progress() == once
+        finally:
+            for project_id in projects.values():
+                client.delete(f"/projects/{project_id}")
+
+
+def test_malformed_lines_are_invalid(ingestor):
+    depot = json.loads(next(line for line in fixture_lines() if "ColonisationConstructionDepot" in line))
+    contribution = json.loads(next(line for line in fixture_lines() if "ColonisationContribution" in line))
+    malformed = ["1", "[1]", '"text"', "null", "{", json.dumps({**depot, "MarketID": 1e999})]
+    for resources in ([1], {"Name": "Steel"}, [{"Name": 1}], [{"Name_Localised": ["Steel"]}]):
+        malformed.append(json.dumps({**depot, "ResourcesRequired": resources}))
+        malformed.append(json.dumps({**contribution, "Contributions": resources}))
+    malformed.append(json.dumps({**contribution, "Contributions": [{"Name": "$Steel_name;", "Amount": 2 ** 31}]}))
+    malformed.append(json.dumps({**contribution, "timestamp": 1744224201}))
+    assert [ingestor.submit_line(line) for line in malformed] == ["invalid"] * len(malformed)
+    assert ingestor.stats["invalid"] == len(malformed)
+    assert ingestor.pending == {}
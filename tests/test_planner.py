@@ -0,0 +1,74 @@
+import numpy as np
+
+from planner import build_plan, pack_holds
+
+
+def trips(plan):
+    return sum(step["trips"] for step in plan)
+
+
+def cargo(plan):
+    totals = {}
+    for step in plan:
+        for commodity, amount in step["cargo"].items():
+            totals[commodity] = totals.get(commodity, 0) + amount * step["trips"]
+    return totals
+
+
+def test_pack_holds_groups_full_loads_and_mixes_the_rest():
+    plan = pack_holds(np.array([2000, 500, 84]), ["Steel", "Aluminium", "Water Purifiers"], 784)
+    assert plan == [
+        {"first_trip": 1, "trips": 2, "cargo": {"Steel": 784}},
+        {"first_trip": 3, "trips": 1, "cargo": {"Steel": 432, "Aluminium": 352}},
+        {"first_trip": 4, "trips": 1, "cargo": {"Aluminium": 148, "Water Purifiers": 84}},
+    ]
+
+
+def test_pack_holds_uses_the_fewest_trips_and_carries_everything():
+    rng = np.random.default_rng(7)
+    for capacity in (8, 400, 784):
+        for _ in range(200):
+            amounts = rng.integers(1, 5 * capacity, size=rng.integers(1, 8))
+            names = [f"c{i}" for i in range(len(amounts))]
+            plan = pack_holds(amounts, names, capacity)
+            assert trips(plan) == -(-int(amounts.sum()) // capacity)
+            assert cargo(plan) == dict(zip(names, amounts.tolist()))
+            # Trips are numbered consecutively and no hold is overfilled.
+            assert [step["first_trip"] for step in plan] == list(np.cumsum([1] + [s["trips"] for s in plan[:-1]]))
+            assert all(sum(step["cargo"].values()) <= capacity for step in plan)
+
+
+def test_pack_holds_cost_does_not_grow_with_trips():
+    plan = pack_holds(np.array([40_000_000, 3]), ["Steel", "Titanium"], 8)
+    assert plan == [
+        {"first_trip": 1, "trips": 5_000_000, "cargo": {"Steel": 8}},
+        {"first_trip": 5_000_001, "trips": 1, "cargo": {"Titanium": 3}},
+    ]
+
+
+def test_empty_plan():
+    assert pack_holds(np.array([], dtype=np.int64), [], 784) == []
+    plan = build_plan([], np.zeros((0, 2), dtype=np.int64), ["Steel", "Water"], [784])
+    assert plan == {"total_remaining": 0, "capacities": [
+        {"capacity": 784, "total_trips": 0, "commodities": [], "projects": [], "plan": []}
+    ]}
+
+
+def test_build_plan_counts_trips_per_commodity_and_project():
+    remaining = np.array([[800, 0, 10], [0, 0, 400]])
+    plan = build_plan([11, 12], remaining, ["Steel", "Water", "Titanium"], [784, 400])
+    assert plan["total_remaining"] == 1210
+    large, medium = plan["capacities"]
+    assert large["total_trips"] == 2 and medium["total_trips"] == 4
+    # Largest commodity first; commodities with nothing left are left out.
+    assert large["commodities"] == [
+        {"commodity": "Steel", "remaining": 800, "trips": 2},
+        {"commodity": "Titanium", "remaining": 410, "trips": 1},
+    ]
+    assert medium["projects"] == [
+        {"project_id": 11, "remaining": 810, "trips": 3},
+        {"project_id": 12, "remaining": 400, "trips": 1},
+    ]
+    for entry in plan["capacities"]:
+        assert trips(entry["plan"]) == entry["total_trips"]
+        assert cargo(entry["plan"]) == {"Steel": 800, "Titanium": 410}
@@ -0,0 +1,234 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from catalog import catalog, HIERARCHY_LEVELS
+from database import AsyncSessionLocal
+from models import System, Project, Commodity, ProjectCommodity
+from progress import compute_totals, resolve_commodity_ids
+
+# Rows fetched per round trip by the export cursor, and lines per streamed chunk.
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_RECORDS = 100000
+MAX_REPORTED_ERRORS = 50
+# Width of the systems.name and projects.name columns.
+MAX_NAME_LENGTH = 255
+
+CSV_COLUMNS = ["system", "project_id", "project", *HIERARCHY_LEVELS, "market_id", "commodity", "required", "remaining"]
+
+# ---------------------
+# Export
+# ---------------------
+# Projects are written with their system name and station requirement keys
+# rather than database ids, so an export can be imported into another board.
+def _station_requirement_keys(station_requirement_id: Optional[int]) -> Optional[dict]:
+    station_req = catalog.get(station_requirement_id)
+    return {level: station_req[level] for level in HIERARCHY_LEVELS} if station_req else None
+
+
+async def _stream_project_rows(session: AsyncSession, system_id: Optional[int]):
+    """One row per (project, commodity), ordered by project, read through a server-side cursor."""
+    query = (
+        select(Project.id, System.name.label("system"), Project.name, Project.station_requirement_id, Project.market_id,
+               Commodity.name.label("commodity"), ProjectCommodity.required, ProjectCommodity.remaining)
+        .join(System, System.id == Project.system_id)
+        .outerjoin(ProjectCommodity, ProjectCommodity.project_id == Project.id)
+        .outerjoin(Commodity, Commodity.id == ProjectCommodity.commodity_id)
+        .order_by(Project.id, ProjectCommodity.commodity_id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if system_id is not None:
+        query = query.filter(Project.system_id == system_id)
+    result = await session.stream(query)
+    async for partition in result.partitions():
+        for row in partition:
+            yield row
+
+
+async def _stream_projects(session: AsyncSession, system_id: Optional[int]):
+    """Group the (project, commodity) rows back into one record per project."""
+    record = None
+    async for row in _stream_project_rows(session, system_id):
+        if record is None or record["id"] != row.id:
+            if record is not None:
+                yield record
+            record = {"id": row.id, "system": row.system, "name": row.name,
+                      "station_requirement": _station_requirement_keys(row.station_requirement_id),
+                      "market_id": row.market_id, "requirements": None, "progress": None}
+        if row.required is not None:
+            record["requirements"] = record["requirements"] or {}
+            record["requirements"][row.commodity] = row.required
+        if row.remaining is not None:
+            record["progress"] = record["progress"] or {}
+            record["progress"][row.commodity] = row.remaining
+    if record is not None:
+        yield record
+
+
+async def export_ndjson(system_id: Optional[int] = None) -> AsyncIterator[bytes]:
+    async with AsyncSessionLocal() as session:
+        query = select(System.name).order_by(System.id)
+        if system_id is not None:
+            query = query.filter(System.id == system_id)
+        lines = [json.dumps({"type": "system", "name": name}) for name in (await session.execute(query)).scalars()]
+        async for project in _stream_projects(session, system_id):
+            del project["id"]
+            lines.append(json.dumps({"type": "project", **project}))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield ("\n".join(lines) + "\n").encode()
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode()
+
+
+async def export_csv(system_id: Optional[int] = None) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    async with AsyncSessionLocal() as session:
+        async for row in _stream_project_rows(session, system_id):
+            keys = _station_requirement_keys(row.station_requirement_id) or {}
+            writer.writerow([row.system, row.id, row.name, *(keys.get(level, "") for level in HIERARCHY_LEVELS),
+                             row.market_id, row.commodity, row.required, row.remaining])
+            count += 1
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue().encode()
+
+# ---------------------
+# Import
+# ---------------------
+def _amounts(value, field: str) -> Optional[Dict[str, int]]:
+    if value is None:
+        return None
+    if not isinstance(value, dict) or not all(isinstance(k, str) and type(v) is int for k, v in value.items()):
+        raise ValueError(f"'{field}' must map commodity names to integers")
+    unknown = [name for name in value if name not in catalog.commodity_ids()]
+    if unknown:
+        raise ValueError(f"unknown commodity in '{field}': {', '.join(unknown[:10])}")
+    return value
+
+
+def parse_import(lines: List[bytes], existing_systems: Dict[str, int]) -> dict:
+    """Validate NDJSON import records up front; raises 400 listing every problem found."""
+    systems, projects, errors = [], [], []
+    declared = set(existing_systems)
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("record must be a JSON object")
+            kind = record.get("type")
+            if kind == "system":
+                name = record.get("name")
+                if not isinstance(name, str) or not name.strip():
+                    raise ValueError("system 'name' is required")
+                if len(name) > MAX_NAME_LENGTH:
+                    raise ValueError(f"system 'name' must be at most {MAX_NAME_LENGTH} characters")
+                if name not in declared:
+                    declared.add(name)
+                    systems.append(name)
+            elif kind == "project":
+                if not isinstance(record.get("name"), str) or not record["name"]:
+                    raise ValueError("project 'name' is required")
+                if len(record["name"]) > MAX_NAME_LENGTH:
+                    raise ValueError(f"project 'name' must be at most {MAX_NAME_LENGTH} characters")
+                # Type checks come first: lists and objects cannot be looked up in sets or the catalog.
+                if not isinstance(record.get("system"), str) or record["system"] not in declared:
+                    raise ValueError(f"unknown system: {record.get('system')!r}")
+                station_req = None
+                keys = record.get("station_requirement")
+                if keys is not None:
+                    if not isinstance(keys, dict) or set(keys) != set(HIERARCHY_LEVELS):
+                        raise ValueError(f"'station_requirement' must have the keys {', '.join(HIERARCHY_LEVELS)}")
+                    if not all(isinstance(value, str) for value in keys.values()):
+                        raise ValueError("'station_requirement' values must be strings")
+                    station_req = catalog.find(**keys)
+                    if station_req is None:
+                        raise ValueError("unknown station requirement: " + " / ".join(str(keys[level]) for level in HIERARCHY_LEVELS))
+                market_id = record.get("market_id")
+                if market_id is not None and type(market_id) is not int:
+                    raise ValueError("'market_id' must be an integer")
+                # Like POST /projects, missing requirements default to the station's
+                # and missing progress starts at the requirements.
+                if "requirements" in record:
+                    requirements = _amounts(record["requirements"], "requirements")
+                else:
+                    requirements = station_req["commodities"] if station_req else None
+                if "progress" in record:
+                    progress = _amounts(record["progress"], "progress")
+                else:
+                    progress = requirements
+                projects.append({"name": record["name"], "system": record["system"], "station_req": station_req,
+                                 "market_id": market_id, "requirements": requirements or {}, "progress": progress or {}})
+            else:
+                raise ValueError("'type' must be 'system' or 'project'")
+        except ValueError as e:
+            errors.append({"line": number, "error": str(e)})
+    if len(systems) + len(projects) > MAX_IMPORT_RECORDS:
+        errors.append({"line": None, "error": f"at most {MAX_IMPORT_RECORDS} records can be imported at once"})
+    if errors:
+        raise HTTPException(status_code=400, detail={"errors": errors[:MAX_REPORTED_ERRORS], "error_count": len(errors)})
+    return {"systems": systems, "projects": projects}
+
+
+async def import_records(session: AsyncSession, parsed: dict, existing_systems: Dict[str, int]) -> dict:
+    """Insert the parsed systems and projects with their progress; does not commit."""
+    system_ids = dict(existing_systems)
+    if parsed["systems"]:
+        result = await session.execute(
+            pg_insert(System).values([{"name": name} for name in parsed["systems"]])
+            .on_conflict_do_nothing(index_elements=["name"]).returning(System.name, System.id)
+        )
+        system_ids.update(result.all())
+        # Systems created concurrently since the up-front check.
+        missing = [name for name in parsed["systems"] if name not in system_ids]
+        if missing:
+            system_ids.update((await session.execute(select(System.name, System.id).filter(System.name.in_(missing)))).all())
+
+    projects = parsed["projects"]
+    commodity_ids = await resolve_commodity_ids(
+        session, [c for p in projects for amounts in (p["requirements"], p["progress"]) for c in amounts]
+    )
+    project_ids = []
+    for i in range(0, len(projects), IMPORT_BATCH_SIZE):
+        batch = []
+        for p in projects[i:i + IMPORT_BATCH_SIZE]:
+            total_required, total_remaining = compute_totals(p["station_req"], p["progress"])
+            batch.append({"name": p["name"], "system_id": system_ids[p["system"]],
+                          "station_requirement_id": p["station_req"]["id"] if p["station_req"] else None,
+                          "market_id": p["market_id"], "total_required": total_required,
+                          "total_remaining": total_remaining})
+        result = await session.execute(insert(Project).returning(Project.id, sort_by_parameter_order=True), batch)
+        project_ids.extend(result.scalars())
+
+    # Commodity rows are loaded with COPY on the session's own connection, inside the same transaction.
+    records = []
+    for project_id, p in zip(project_ids, projects):
+        for commodity in dict.fromkeys([*p["requirements"], *p["progress"]]):
+            records.append((project_id, commodity_ids[commodity],
+                            p["requirements"].get(commodity), p["progress"].get(commodity)))
+    if records:
+        connection = await (await session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(
+            "project_commodities", records=records, columns=["project_id", "commodity_id", "required", "remaining"]
+        )
+    return {
+        "systems_created": len(parsed["systems"]),
+        "projects_created": len(project_ids),
+        "commodity_rows": len(records),
+        "system_ids": sorted({system_ids[p["system"]] for p in projects} | {system_ids[name] for name in parsed["systems"]}),
+    }
@@ -0,0 +1,64 @@
+import uuid
+import zlib
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from fastapi import Request, Response
+
+from catalog import catalog
+
+
+class ChangeVersions:
+    """Process-local change counters used to build ETags without querying the database.
+
+    Write paths bump the counters after committing; read endpoints derive their
+    ETag from the relevant counter *before* reading, so a response can only ever
+    be labelled with an older version than its content, never a newer one.
+    """
+
+    def __init__(self):
+        # Distinguishes this process (and this boot) so ETags handed out by
+        # another worker or before a restart never match by accident.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.global_version = 0
+        self.systems = defaultdict(int)
+        self.projects = defaultdict(int)
+
+    def bump(self, system_ids: Iterable[int] = (), project_ids: Iterable[int] = ()):
+        self.global_version += 1
+        for system_id in system_ids:
+            self.systems[system_id] += 1
+        for project_id in project_ids:
+            self.projects[project_id] += 1
+
+    def reset(self):
+        """Invalidate every ETag handed out so far, for when changes may have been missed."""
+        self.epoch = uuid.uuid4().hex[:8]
+        self.global_version += 1
+        self.systems.clear()
+        self.projects.clear()
+
+    def system(self, system_id: int) -> int:
+        return self.systems.get(system_id, 0)
+
+    def project(self, project_id: int) -> int:
+        return self.projects.get(project_id, 0)
+
+    def etag(self, request: Request, version: int) -> str:
+        # Station requirement data is embedded in most responses, so every
+        # ETag also changes when the catalog is reloaded.
+        url = request.url.path + "?" + request.url.query
+        return f'W/"{self.epoch}-{catalog.version}-{version}-{zlib.crc32(url.encode()):08x}"'
+
+
+def conditional(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Set the ETag on the response, or return a 304 if the client already has this version."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return None
+
+
+versions = ChangeVersions()